@@ -0,0 +1,103 @@
+"""一次刷新的写入次数与耗时：逐条提交与 write_batch 合并提交的对比。
+
+在临时的 HOME 下模拟一次完整刷新（学期列表、课程列表、各课程的作业列表），上游网页由本脚本生成，不会联网。
+统计 cache_data.db 的提交次数（cachemanager.commit_count）和总耗时。
+
+用法：python benchmarks/bench_batch_writes.py [课程数] [轮数]，默认 12 门课程、5 轮。
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+import urllib.parse as urlparse
+
+HOME = tempfile.mkdtemp(prefix="ohmyddl-bench-")
+os.environ["HOME"] = os.environ["USERPROFILE"] = HOME
+os.environ.setdefault("OHMYDDL_NO_CHECK", "1")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ohmyddl import cachemanager  # noqa: E402
+from ohmyddl.models import ChaoxingUser  # noqa: E402
+
+WORKS = 10
+
+
+def fake_page(url, params, n_courses):
+    if "space/index" in url:
+        return '"http://www.elearning.shu.edu.cn/courselist/study?s=bench"'
+    if "courselist/study" in url and not params:
+        return ("<html><body><ul class='zse_ul'><li class='zse_li'><a data_year='2019' data_term='3'>"
+                " 2019-2020春季 </a></li></ul></body></html>")
+    if "courselist/study" in url:
+        items = "".join(
+            f"<li class='zmy_item'><a href='http://mooc1.elearning.shu.edu.cn/course{i}'></a><dl>"
+            f"<dt name='courseNameHtml'> 课程{i} <span>(0{i})</span></dt><dd name='userNameHtml'> 教师 </dd></dl></li>"
+            for i in range(n_courses))
+        return f"<html><body><ul>{items}</ul></body></html>"
+    if "/course" in url:
+        i = url.rsplit("course", 1)[1]
+        return f'"/work/getAllWork?classId=10{i}&courseId=20{i}&cpi=300&enc=x"'
+    if "getAllWork" in url:
+        i = urlparse.parse_qs(urlparse.urlparse(url).query)["classId"][0]
+        items = "".join(
+            f"<li><div class='titTxt'><p><a title='作业{i}-{j}'>x</a></p>"
+            f"<span class='pt5'> 2020-03-01 08:00 </span><span class='pt5'> 2030-04-1{j % 10} 23:59 </span>"
+            f"<span><strong> {'待做' if j % 2 else '已完成'} </strong></span>"
+            f"<a data='{j}' data3='0'><span>做作业</span></a></div></li>"
+            for j in range(WORKS))
+        return f"<html><body>/work/doHomeWorkNew?enc=E{i}&x<div class='ulDiv'><ul>{items}</ul></div></body></html>"
+    return ""
+
+
+def make_user(n_courses):
+    def http_request(self, url, method, params=None, data=None, referer=None, auto_retry=3, timeout=None):
+        text = fake_page(url, params, n_courses)
+        return types.SimpleNamespace(text=text, url=url, status_code=200, content=text.encode())
+    ChaoxingUser.http_request = http_request
+    return ChaoxingUser("12345678", "x")
+
+
+def refresh(user):
+    user.get_term_id_list(disable_cache=True)
+    course_list = user.get_course_list(disable_cache=True)
+    user.fetch_work_lists(course_list, disable_cache=True)
+
+
+def run(user, rounds, batched):
+    commits = cachemanager.commit_count()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        if batched:
+            with user.write_batch():
+                refresh(user)
+        else:
+            refresh(user)
+    elapsed = time.perf_counter() - start
+    return (cachemanager.commit_count() - commits) / rounds, elapsed / rounds
+
+
+def main():
+    n_courses = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    try:
+        user = make_user(n_courses)
+        # 预热：建表、导入 lxml 等
+        refresh(user)
+        print(f"{n_courses} 门课程 x {WORKS} 个作业，{rounds} 轮")
+        print(f"{'':<12}{'提交次数/轮':>12}{'耗时 ms/轮':>12}")
+        results = dict()
+        for name, batched in (("逐条提交", False), ("write_batch", True)):
+            results[name] = run(user, rounds, batched)
+            commits, elapsed = results[name]
+            print(f"{name:<12}{commits:>12.0f}{elapsed * 1000:>12.1f}")
+        if results["write_batch"][0] != 1:
+            print("write_batch 的提交次数不为 1")
+            sys.exit(1)
+    finally:
+        shutil.rmtree(HOME, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""缓存值压缩的效果：各压缩方式下的保存大小与压缩、解压耗时。
+
+值为模拟的课程列表（较长的 pageUrl）和作业列表（WorkTable）pickle 后的结果。
+
+用法：python benchmarks/bench_cache_compression.py [课程数]，默认 20 门课程、每门 20 个作业。
+"""
+import os
+import pickle
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OHMYDDL_NO_CHECK", "1")
+
+from ohmyddl import cachemanager  # noqa: E402
+from ohmyddl.models import CourseInfo, WorkTable  # noqa: E402
+
+REPEAT = 20
+
+
+def make_values(n_courses, n_works=20):
+    courses = [
+        CourseInfo(
+            pageUrl=f"http://mooc1.elearning.shu.edu.cn/visit/stucoursemiddle?courseid={200000000 + i}"
+                    f"&clazzid={100000000 + i}&vc=1&cpi=64590381&ismooc2=1",
+            courseName=f"课程{i}（{'A' if i % 2 else 'B'}）",
+            teacherName=f"教师{i % 7}",
+            courseSeq=f"0{i:04d}"
+        )
+        for i in range(n_courses)
+    ]
+    values = [("get_course_list", pickle.dumps(courses))]
+    for i in range(n_courses):
+        table = WorkTable(str(200000000 + i), str(100000000 + i), "f7b9e17b6c978b006dea24fcc54cbbe7", "64590381")
+        for j in range(n_works):
+            table.append(f"第{j + 1}章 课后作业", 1583366400 + j * 86400, 1586879940 + j * 86400,
+                         "待做" if j % 3 else "已完成", str(3000000 + i * 100 + j), "0")
+        values.append(("get_work_list", pickle.dumps(table)))
+    return values
+
+
+def run(codec, values):
+    cachemanager.configure(codec=codec)
+    stored = [cachemanager.encode_value(v) for _, v in values]
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        [cachemanager.encode_value(v) for _, v in values]
+    encode = (time.perf_counter() - start) / REPEAT
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        decoded = [cachemanager.decode_value(x) for x in stored]
+    decode = (time.perf_counter() - start) / REPEAT
+    if decoded != [v for _, v in values]:
+        print(f"{codec}: 解压结果不一致")
+        sys.exit(1)
+    return sum(len(x) for x in stored), encode, decode
+
+
+def main():
+    n_courses = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    values = make_values(n_courses)
+    raw = sum(len(v) for _, v in values)
+    print(f"{len(values)} 个缓存值，共 {raw} 字节，压缩阈值 {cachemanager.COMPRESS_THRESHOLD} 字节")
+    print(f"{'codec':<8}{'保存字节':>10}{'比例':>8}{'压缩 ms':>10}{'解压 ms':>10}")
+    for codec in ("none", "zlib", "lzma"):
+        size, encode, decode = run(codec, values)
+        print(f"{codec:<8}{size:>10}{size / raw:>8.0%}{encode * 1000:>10.2f}{decode * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
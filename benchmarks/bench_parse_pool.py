@@ -0,0 +1,82 @@
+"""网页解析进程池的效果。
+
+1. 单次解析：不同大小的作业列表页直接解析与交给进程池解析的耗时，进程池多出的是传输和调度的开销，
+   用来确定 parsers.INLINE_THRESHOLD；
+2. 并发解析：多个线程同时解析较大的网页（模拟多个用户同时刷新），直接解析与进程池解析的吞吐量。
+
+用法：python benchmarks/bench_parse_pool.py [线程数] [进程池大小]，默认 8 个线程、进程数为 CPU 核数。
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OHMYDDL_NO_CHECK", "1")
+
+from ohmyddl import parsers  # noqa: E402
+
+REPEAT = 20
+
+
+def make_page(n_works):
+    items = "".join(
+        f"<li><div class='titTxt'><p><a title='第{j + 1}章 课后作业'>第{j + 1}章 课后作业</a></p>"
+        f"<span class='pt5'> 2020-03-{j % 28 + 1:02d} 08:00 </span><span class='pt5'> 2020-04-{j % 28 + 1:02d} 23:59 </span>"
+        f"<span><strong> {'待做' if j % 3 else '已完成'} </strong></span>"
+        f"<div class='Btn'><a href='javascript:;' data='{3000000 + j}' data2='{4000000 + j}' data3='0'>"
+        f"<span>做作业</span></a></div></div></li>"
+        for j in range(n_works))
+    return (f"<html><head><title>作业</title></head><body>/work/doHomeWorkNew?courseId=1&enc=f7b9e17b6c978b006dea24fcc54cbbe7&x"
+            f"<div class='ulDiv'><ul>{items}</ul></div></body></html>")
+
+
+def timed(page, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        parsers.parse(parsers.parse_work_list, page)
+    return (time.perf_counter() - start) / n
+
+
+def single(processes):
+    print(f"{'作业数':<8}{'网页字符':>10}{'直接 ms':>10}{'进程池 ms':>12}")
+    for n_works in (5, 20, 50, 100, 200, 400):
+        page = make_page(n_works)
+        parsers.configure(processes=0)
+        timed(page, 2)
+        inline = timed(page, REPEAT)
+        parsers.configure(processes=processes, threshold=0)
+        timed(page, 2)  # 启动进程池
+        pooled = timed(page, REPEAT)
+        print(f"{n_works:<8}{len(page):>10}{inline * 1000:>10.2f}{pooled * 1000:>12.2f}")
+
+
+def concurrent(threads, processes):
+    page = make_page(200)
+    total = threads * REPEAT
+    print(f"{threads} 个线程同时解析 {total} 次（每页 {len(page)} 字符）")
+    for name, n in (("直接解析", 0), (f"进程池 {processes}", processes)):
+        parsers.configure(processes=n, threshold=0)
+        timed(page, 2)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(lambda _: parsers.parse(parsers.parse_work_list, page), range(total)))
+        elapsed = time.perf_counter() - start
+        print(f"{name:<12}{total / elapsed:>10.1f} 页/秒")
+    stats = parsers.stats()
+    print(f"进程池平均排队 {stats['avg_queue_seconds'] * 1000:.2f} ms，"
+          f"最长 {stats['max_queue_seconds'] * 1000:.2f} ms")
+    parsers.configure(processes=0)
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else (os.cpu_count() or 1)
+    print(f"CPU 核数 {os.cpu_count()}，进程池 {processes} 个进程")
+    single(processes)
+    print()
+    concurrent(threads, processes)
+
+
+if __name__ == "__main__":
+    main()
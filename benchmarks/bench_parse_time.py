@@ -0,0 +1,49 @@
+"""作业起止时间解析的耗时对比：utils.parse_work_time 与 datetime.strptime。
+
+用法：python benchmarks/bench_parse_time.py [条数]，默认 10000 条，每种方法取 5 次中的最小值。
+"""
+import os
+import random
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OHMYDDL_NO_CHECK", "1")
+
+from ohmyddl.utils import SHANGHAI_TZ, WORK_TIME_FORMAT, parse_work_time  # noqa: E402
+
+
+def make_samples(n):
+    rnd = random.Random(0)
+    return [
+        f"20{rnd.randint(19, 25)}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d} "
+        f"{rnd.randint(0, 23):02d}:{rnd.randint(0, 59):02d}"
+        for _ in range(n)
+    ]
+
+
+def by_strptime(samples):
+    return [datetime.strptime(x, WORK_TIME_FORMAT).replace(tzinfo=SHANGHAI_TZ) for x in samples]
+
+
+def by_parse_work_time(samples):
+    return [parse_work_time(x) for x in samples]
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    samples = make_samples(n)
+    if by_strptime(samples) != by_parse_work_time(samples):
+        print("解析结果不一致")
+        sys.exit(1)
+    results = dict()
+    for func in (by_strptime, by_parse_work_time):
+        results[func.__name__] = min(timeit.repeat(lambda: func(samples), number=1, repeat=5))
+        print(f"{func.__name__:<20} {results[func.__name__] * 1000:8.2f} ms  "
+              f"{results[func.__name__] / n * 1e6:6.2f} us/条")
+    print(f"加速：{results['by_strptime'] / results['by_parse_work_time']:.1f}x（{n} 条）")
+
+
+if __name__ == "__main__":
+    main()
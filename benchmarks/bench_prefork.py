@@ -0,0 +1,118 @@
+"""多进程服务器的吞吐量：不同进程数下每秒完成的刷新请求数。
+
+每个客户端线程使用各自的用户，不断请求 /api/get_unfinish_works（disable_cache），
+服务器每次都要解析作业列表网页、写入缓存和 work 表，主要耗时在 lxml 解析和序列化上。
+上游网页由 stress_concurrency.py 生成，不会联网。进程数超过 CPU 核数后吞吐量不会再增加。
+
+用法：python benchmarks/bench_prefork.py [客户端线程数] [每种进程数的测试秒数]，默认 8 个线程、10 秒。
+"""
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import stress_concurrency as fake
+
+ROOT = fake.ROOT
+USER_PREFIX = "1000"
+
+
+def sid_of(i):
+    # sid 只能是 32 个字母
+    return "".join(chr(ord("a") + int(x)) for x in f"{i:032d}")
+
+
+def prepare(env, n_users):
+    code = ("import sys; sys.path.insert(0, sys.argv[1]); "
+            "from ohmyddl import DATA_DIR; from ohmyddl.models import ChaoxingUser; "
+            "[ChaoxingUser(name, 'x').dump_to(str(DATA_DIR / sid)) for name, sid in zip(sys.argv[2::2], sys.argv[3::2])]")
+    args = list()
+    for i in range(n_users):
+        args.extend([f"{USER_PREFIX}{i:04d}", sid_of(i)])
+    subprocess.run([sys.executable, "-c", code, ROOT] + args, env=env, check=True)
+
+
+def measure(env, workers, n_threads, seconds):
+    port = fake.free_port()
+    server = subprocess.Popen([sys.executable, os.path.abspath(fake.__file__), "--server", str(port), str(workers)],
+                              env=env, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    done = [0] * n_threads
+    errors = [0] * n_threads
+    stop = threading.Event()
+
+    def client(i):
+        while not stop.is_set():
+            try:
+                ret = post(port, sid_of(i))
+            except Exception:
+                ret = None
+            if ret == 0:
+                done[i] += 1
+            else:
+                errors[i] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(n_threads)]
+    for t in threads:
+        t.start()
+    # 预热后再计数
+    time.sleep(1)
+    base = sum(done)
+    start = time.time()
+    time.sleep(seconds)
+    count = sum(done) - base
+    elapsed = time.time() - start
+    stop.set()
+    for t in threads:
+        t.join()
+    server.terminate()
+    server.wait()
+    return count / elapsed, sum(errors)
+
+
+def post(port, sid):
+    req = urllib.request.Request(
+        f"http://127.0.0.1:{port}/api/get_unfinish_works", data=b'{"disable_cache": true}',
+        headers={"Content-Type": "application/json", "Cookie": f"sid={sid}"})
+    with urllib.request.urlopen(req, timeout=60) as r:
+        return json.loads(r.read().decode("utf-8"))["ret"]
+
+
+def main():
+    n_threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    cpus = os.cpu_count() or 1
+    counts = sorted({1, 2, 4, cpus})
+    home = tempfile.mkdtemp(prefix="ohmyddl-prefork-")
+    env = dict(os.environ, HOME=home, USERPROFILE=home, OHMYDDL_NO_CHECK="1",
+               PYTHONPATH=os.pathsep.join([ROOT, os.environ.get("PYTHONPATH", "")]))
+    try:
+        prepare(env, n_threads)
+        print(f"CPU 核数 {cpus}，{n_threads} 个客户端线程，每种 {seconds:.0f} 秒")
+        print(f"{'进程数':<8}{'请求/秒':>10}{'相对单进程':>12}{'失败':>6}")
+        single = None
+        for workers in counts:
+            rate, errors = measure(env, workers, n_threads, seconds)
+            if single is None:
+                if rate == 0:
+                    print(f"单进程没有完成任何请求（失败 {errors} 次），无法计算相对速度")
+                    sys.exit(1)
+                single = rate
+            print(f"{workers:<8}{rate:>10.1f}{rate / single:>11.1f}x{errors:>6}")
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
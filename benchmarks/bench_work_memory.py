@@ -0,0 +1,75 @@
+"""作业列表的内存占用对比：List[WorkInfo] 与 WorkTable。
+
+模拟解析网页得到的数据（每个作业的 courseId、classId 等都是独立的 str 对象），
+用 tracemalloc 统计常驻内存，并比较 pickle 后的大小。
+
+用法：python benchmarks/bench_work_memory.py [课程数] [每门课程的作业数]，默认 200 门课程、每门 20 个作业。
+"""
+import os
+import pickle
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OHMYDDL_NO_CHECK", "1")
+
+from ohmyddl.models import WorkInfo, WorkTable  # noqa: E402
+from ohmyddl.utils import parse_work_time  # noqa: E402
+
+
+def fresh(s):
+    """返回与 s 相等但不共用的 str 对象，模拟每次从网页解析出的字符串
+    """
+    return (s + "#")[:-1]
+
+
+def make_course(i, n_works):
+    works = list()
+    for j in range(n_works):
+        works.append(WorkInfo(
+            workName=f"第{j + 1}章 课后作业（课程{i}）",
+            startTime=parse_work_time(f"2020-03-{j % 28 + 1:02d} 08:00"),
+            endTime=parse_work_time(f"2020-04-{j % 28 + 1:02d} 23:59"),
+            workStatus=fresh("待做" if j % 3 else "已完成"),
+            courseId=fresh(str(200000000 + i)),
+            classId=fresh(str(100000000 + i)),
+            workRelationId=str(3000000 + i * 100 + j),
+            workRelationAnswerId=str(3000000 + i * 100 + j),
+            workReEdit=fresh("0"),
+            enc=fresh("f7b9e17b6c978b006dea24fcc54cbbe7"),
+            cpi=fresh("64590381")
+        ))
+    return works
+
+
+def measure(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    data = build()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return data, size
+
+
+def main():
+    n_courses = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    n_works = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    total = n_courses * n_works
+    # 两种表示各自从头生成，统计的内存包括其引用的全部字符串和 datetime
+    lists, list_size = measure(lambda: [make_course(i, n_works) for i in range(n_courses)])
+    tables, table_size = measure(lambda: [WorkTable.from_works(make_course(i, n_works)) for i in range(n_courses)])
+    if [list(x) for x in tables] != lists:
+        print("WorkTable 与原列表不一致")
+        sys.exit(1)
+    list_pickle = sum(len(pickle.dumps(x)) for x in lists)
+    table_pickle = sum(len(pickle.dumps(x)) for x in tables)
+
+    print(f"{n_courses} 门课程 x {n_works} 个作业 = {total} 个作业")
+    print(f"{'':<16}{'内存 B/作业':>12}{'pickle B/作业':>16}")
+    print(f"{'List[WorkInfo]':<16}{list_size / total:>12.0f}{list_pickle / total:>16.0f}")
+    print(f"{'WorkTable':<16}{table_size / total:>12.0f}{table_pickle / total:>16.0f}")
+    print(f"内存减少 {1 - table_size / list_size:.0%}，pickle 减少 {1 - table_pickle / list_pickle:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""启动时间检查。
+
+用 python -X importtime 导入 ohmyddl.__main__（ohmyddl-cli 的入口），检查：
+
+- 累计导入时间不超过 STARTUP_BUDGET_US（微秒）；
+- 没有导入 lxml、requests、bottle，这些模块只应在第一次联网、解析或启动 web 时导入。
+
+用法：python benchmarks/check_startup.py [次数]，取多次中的最小值，超出预算时退出码为 1。
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+
+# 启动预算：导入 ohmyddl.__main__ 的累计时间，单位：微秒
+STARTUP_BUDGET_US = 50000
+FORBIDDEN_MODULES = ["lxml", "lxml.etree", "requests", "ohmyddl.bottle"]
+
+
+def import_time():
+    """返回 (ohmyddl.__main__ 的累计导入时间, 导入过的模块名集合)
+    """
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home, USERPROFILE=home, OHMYDDL_NO_CHECK="1")
+        p = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import ohmyddl.__main__"],
+            env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    modules = set()
+    total = None
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        name = name.strip()
+        modules.add(name)
+        if name == "ohmyddl.__main__":
+            total = int(cumulative)
+    return total, modules
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    results = [import_time() for _ in range(n)]
+    best = min(x[0] for x in results)
+    imported = set.union(*[x[1] for x in results])
+    print(f"import ohmyddl.__main__: {best / 1000:.1f} ms (budget {STARTUP_BUDGET_US / 1000:.1f} ms)")
+    failed = False
+    if best > STARTUP_BUDGET_US:
+        print("超出启动时间预算")
+        failed = True
+    forbidden = [x for x in FORBIDDEN_MODULES if x in imported]
+    if forbidden:
+        print(f"启动时导入了：{', '.join(forbidden)}")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
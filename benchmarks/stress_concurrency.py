@@ -0,0 +1,197 @@
+"""命令行与服务器并发访问数据目录的压力测试。
+
+在临时的 HOME 下启动服务器，同时运行 N 个命令行进程（均强制刷新），并不断请求服务器，
+上游网站用本脚本生成的页面代替，不会联网。结束后检查：
+
+- 没有进程出现 "database is locked" 或异常退出；
+- 服务器的请求都成功；
+- .user_data、.user_name、会话文件都能完整读取，cache_data.db 通过 integrity_check。
+
+用法：python benchmarks/stress_concurrency.py [命令行进程数] [每个进程的查询次数] [服务器进程数]，
+默认 8 个进程、每个 5 次，服务器为单进程。
+"""
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.parse as urlparse
+import urllib.request
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+USER_NAME = "12345678"
+SID = "s" * 32
+COURSES = 6
+WORKS = 8
+
+
+def fake_page(url, params=None):
+    """模拟的上游页面
+    """
+    if "space/index" in url:
+        return '"http://www.elearning.shu.edu.cn/courselist/study?s=stress"'
+    if "courselist/study" in url and not params:
+        return ("<html><body><ul class='zse_ul'><li class='zse_li'><a data_year='2019' data_term='3'>"
+                " 2019-2020春季 </a></li></ul></body></html>")
+    if "courselist/study" in url:
+        items = "".join(
+            f"<li class='zmy_item'><a href='http://mooc1.elearning.shu.edu.cn/course{i}'></a><dl>"
+            f"<dt name='courseNameHtml'> 课程{i} <span>(0{i})</span></dt><dd name='userNameHtml'> 教师 </dd></dl></li>"
+            for i in range(COURSES))
+        return f"<html><body><ul>{items}</ul></body></html>"
+    if "/course" in url:
+        i = url[-1]
+        return f'"/work/getAllWork?classId=10{i}&courseId=20{i}&cpi=300&enc=x"'
+    if "getAllWork" in url:
+        i = urlparse.parse_qs(urlparse.urlparse(url).query)["classId"][0]
+        # 每次返回的状态不同，让作业变化记录、work 表都有写入
+        status = "待做" if int(time.time() * 10) % 2 else "已完成"
+        items = "".join(
+            f"<li><div class='titTxt'><p><a title='作业{i}-{j}'>x</a></p>"
+            f"<span class='pt5'> 2020-03-01 08:00 </span><span class='pt5'> 2030-04-1{j} 23:59 </span>"
+            f"<span><strong> {status if j % 2 else '待做'} </strong></span>"
+            f"<a data='{j}' data3='0'><span>做作业</span></a></div></li>"
+            for j in range(WORKS))
+        return f"<html><body>/work/doHomeWorkNew?enc=E{i}&x<div class='ulDiv'><ul>{items}</ul></div></body></html>"
+    if "topjs" in url:
+        return "afterLogin"
+    return ""
+
+
+def install_fake_upstream():
+    from ohmyddl.models import ChaoxingUser
+
+    def http_request(self, url, method, params=None, data=None, referer=None, auto_retry=3, timeout=None):
+        text = fake_page(url, params)
+        return types.SimpleNamespace(text=text, url=url, status_code=200, content=text.encode())
+    ChaoxingUser.http_request = http_request
+    ChaoxingUser.login = lambda self: None
+
+
+def run_server(port, workers=1):
+    install_fake_upstream()
+    from ohmyddl import server
+    from ohmyddl.bottle import run
+    if workers > 1:
+        run(host="127.0.0.1", port=port, server=server.PreforkServer, workers=workers,
+            background=server.refresher.run, quiet=True)
+        return
+    server.refresher.start()
+    run(host="127.0.0.1", port=port, server_class=server.ThreadingWSGIServer, quiet=True)
+
+
+def run_cli(rounds):
+    install_fake_upstream()
+    from ohmyddl import __main__ as cli
+    for _ in range(rounds):
+        sys.argv = ["ohmyddl", "-f"]
+        cli.cli()
+
+
+def post(port, path, body):
+    req = urllib.request.Request(
+        f"http://127.0.0.1:{port}{path}", data=json.dumps(body).encode(),
+        headers={"Content-Type": "application/json", "Cookie": f"sid={SID}"})
+    with urllib.request.urlopen(req, timeout=60) as r:
+        return json.loads(r.read().decode("utf-8"))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    home = tempfile.mkdtemp(prefix="ohmyddl-stress-")
+    env = dict(os.environ, HOME=home, USERPROFILE=home, OHMYDDL_NO_CHECK="1",
+               PYTHONPATH=os.pathsep.join([ROOT, os.environ.get("PYTHONPATH", "")]))
+    prepare = ("import sys; sys.path.insert(0, sys.argv[1]); "
+               "from ohmyddl import DATA_DIR; from ohmyddl.models import ChaoxingUser; "
+               f"ChaoxingUser({USER_NAME!r}, 'x').dump_to(str(DATA_DIR / '.user_data')); "
+               f"ChaoxingUser({USER_NAME!r}, 'x').dump_to(str(DATA_DIR / {SID!r}))")
+    subprocess.run([sys.executable, "-c", prepare, ROOT], env=env, check=True)
+
+    port = free_port()
+    me = os.path.abspath(__file__)
+    server = subprocess.Popen([sys.executable, me, "--server", str(port), str(workers)], env=env,
+                              stderr=subprocess.PIPE, universal_newlines=True)
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+
+    server_results = list()
+    stop = threading.Event()
+
+    def hammer():
+        while not stop.is_set():
+            try:
+                server_results.append(post(port, "/api/get_unfinish_works", {"disable_cache": True})["ret"])
+            except Exception as e:
+                server_results.append(repr(e))
+
+    start = time.time()
+    threads = [threading.Thread(target=hammer) for _ in range(2)]
+    for t in threads:
+        t.start()
+    clis = [subprocess.Popen([sys.executable, me, "--cli", str(rounds)], env=env, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, universal_newlines=True)
+            for _ in range(n)]
+    cli_errors = list()
+    for p in clis:
+        _, err = p.communicate()
+        if p.returncode != 0 or "Traceback" in err or "locked" in err:
+            cli_errors.append(err.strip().splitlines()[-1] if err.strip() else f"exit {p.returncode}")
+    stop.set()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    server.terminate()
+    _, server_err = server.communicate()
+
+    check = ("import sys, pickle; sys.path.insert(0, sys.argv[1]); "
+             "from ohmyddl import DATA_DIR; import ohmyddl.models; "
+             f"[pickle.loads((DATA_DIR / x).read_bytes()) for x in ('.user_data', {SID!r})]; "
+             "print((DATA_DIR / '.user_name').read_text())")
+    files = subprocess.run([sys.executable, "-c", check, ROOT], env=env, stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE, universal_newlines=True)
+    conn = sqlite3.connect(os.path.join(home, ".ohmyddl", "cache_data.db"))
+    integrity = conn.execute("pragma integrity_check;").fetchone()[0]
+    journal_mode = conn.execute("pragma journal_mode;").fetchone()[0]
+    conn.close()
+    shutil.rmtree(home, ignore_errors=True)
+
+    failed_requests = [x for x in server_results if x != 0]
+    print(f"{n} 个命令行进程 x {rounds} 次，服务器 {workers} 个进程，服务器请求 {len(server_results)} 次，用时 {elapsed:.1f} s，"
+          f"journal_mode={journal_mode}")
+    print(f"命令行失败：{len(cli_errors)}  {cli_errors[:3]}")
+    print(f"服务器请求失败：{len(failed_requests)}  {failed_requests[:3]}")
+    print(f"服务器 database is locked：{server_err.count('database is locked')}")
+    print(f"用户文件：{'完整' if files.returncode == 0 and files.stdout.strip() == USER_NAME else files.stderr}")
+    print(f"integrity_check：{integrity}")
+    ok = (not cli_errors and not failed_requests and "database is locked" not in server_err
+          and files.returncode == 0 and integrity == "ok")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--server":
+        sys.path.insert(0, ROOT)
+        run_server(int(sys.argv[2]), int(sys.argv[3]) if len(sys.argv) > 3 else 1)
+    elif len(sys.argv) > 2 and sys.argv[1] == "--cli":
+        sys.path.insert(0, ROOT)
+        run_cli(int(sys.argv[2]))
+    else:
+        main()
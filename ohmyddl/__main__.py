@@ -1,17 +1,21 @@
-import argparse
 import logging
 import sys
+import time
 from datetime import datetime
 from getpass import getpass
 
 from . import DATA_DIR
+from .cachemanager import SCOPE_GLOBAL, CacheManager, make_key_str, scoped_cache_id
 from .exceptions import PasswordError
-from .models import ChaoxingUser
-from .utils import fetch_term_desc, get_course_alias, table, check_available
+from .models import CACHE_DB, ChaoxingUser, work_store
+from .store import PENDING
+from .utils import SHANGHAI_TZ, WORK_TIME_FORMAT, fetch_term_desc, format_age, get_course_alias, table, check_available, \
+    write_file_atomic
 
 DATA_FILE = DATA_DIR / ".user_data"
+# 保存的学号。只读缓存时不需要反序列化整个用户对象（会导入 requests）
+USER_NAME_FILE = DATA_DIR / ".user_name"
 logger = logging.getLogger(__name__)
-check_available()
 
 
 def setup_logging(level=logging.ERROR):
@@ -50,9 +54,42 @@ def save_user_data(user):
     parent = DATA_FILE.parent
     parent.mkdir(exist_ok=True)
     user.dump_to(str(DATA_FILE))
+    write_file_atomic(USER_NAME_FILE, user.userName.encode("utf-8"))
+
+
+def saved_user_name():
+    """已保存的学号，没有时返回 None
+    """
+    if USER_NAME_FILE.exists():
+        return USER_NAME_FILE.read_text(encoding="utf-8").strip()
+    if DATA_FILE.exists():
+        return ChaoxingUser.load_from(str(DATA_FILE)).userName
+    return None
+
+
+def store_update_time(user_name, term_id, check_expire=True):
+    """本地 work 表中 term_id 学期数据的更新时间，不登录，也不导入 lxml、requests。
+    没有数据，或 check_expire 为 True 且学期列表、课程列表、作业任一项的缓存已过期、有课程还没有获取过作业时
+    返回 None。check_expire 为 False（离线模式）时，部分课程获取失败也返回已有数据的更新时间。
+    """
+    update_time = work_store.update_time(user_name, term_id, complete=check_expire)
+    if update_time is None or not check_expire:
+        return update_time
+    term_time = CacheManager(scoped_cache_id(SCOPE_GLOBAL), CACHE_DB).get_update_time(
+        make_key_str("get_term_id_list", (), {}))
+    course_time = CacheManager(user_name, CACHE_DB).get_update_time(
+        make_key_str("get_course_list", (), {"term_id": term_id}))
+    if term_time is None or course_time is None:
+        return None
+    now = time.time()
+    if now - term_time >= 86400 or now - course_time >= 86400 or now - update_time >= ChaoxingUser.CACHE_EXPIRE_TIME:
+        return None
+    return update_time
 
 
 def cli():
+    import argparse
+    check_available()
     prog = "ohmyddl.exe" if "win32" == sys.platform else "ohmyddl"
     parser = argparse.ArgumentParser(description="超星学习通作业汇总。", prog=prog)
     parser.add_argument("-c", help="不使用已保存学号", action="store_true")
@@ -60,6 +97,11 @@ def cli():
         "-f", help="强制刷新（若10分钟内查询过，会优先使用缓存的数据）", action="store_true")
     parser.add_argument(
         "-t", help="学期ID，默认使用当前学期。格式：20192表示2019冬季学期。", type=int)
+    parser.add_argument(
+        "-o", help="离线模式：不登录、不联网，使用上次查询的数据（不论是否过期）", action="store_true")
+    parser.add_argument("-n", help="只显示最近截止的 N 个作业", type=int)
+    parser.add_argument(
+        "-a", help="汇总所有学期（往届学期只获取一次，保存在本地）", action="store_true")
     parser.add_argument("-v", help="输出调试信息", action="store_true")
     args = parser.parse_args()
     if args.v:
@@ -67,45 +109,93 @@ def cli():
     else:
         setup_logging()
 
-    user = solve_account(re_login=args.c)
     term_id = args.t if args.t else -1
     disable_cache = args.f
     logger.info(f"disable_cache: {disable_cache}")
-    term_id_list = user.get_term_id_list(disable_cache=disable_cache)
-    course_list = user.get_course_list(
-        term_id=term_id, disable_cache=disable_cache)
-    work_list = dict()
-    for course in course_list:
-        works = user.get_work_list(course.pageUrl, disable_cache=disable_cache)
-        work_list[course.courseName] = works
-
-    no_work_course = list()
+    if args.a:
+        user = solve_account(re_login=args.c)
+        print_history_table(user, user.fetch_history(disable_cache=disable_cache))
+        save_user_data(user)
+        return
+
+    user = None
+    update_time = None
+    if args.o:
+        user_name = saved_user_name()
+        if user_name is None:
+            print("没有保存的学号，请先联网查询一次")
+            exit(1)
+        update_time = store_update_time(user_name, term_id, check_expire=False)
+        if update_time is None:
+            print("没有缓存的数据，请先联网查询一次")
+            exit(1)
+        print(f"离线模式，数据更新于{format_age(time.time() - update_time)}")
+    elif not (args.c or disable_cache) and USER_NAME_FILE.exists():
+        user_name = saved_user_name()
+        update_time = store_update_time(user_name, term_id)
+    dropped = list()
+    if update_time is not None:
+        logger.info("all data cached, skip login")
+    else:
+        user = solve_account(re_login=args.c)
+        user_name = user.userName
+        # 所有写入在获取结束后一次提交，之后从 work 表读取
+        with user.write_batch():
+            user.get_term_id_list(disable_cache=disable_cache)
+            course_list = user.get_course_list(
+                term_id=term_id, disable_cache=disable_cache)
+            with user.time_budget(user.UNFINISH_WORK_BUDGET):
+                _, dropped = user.fetch_work_lists(
+                    course_list, disable_cache=disable_cache)
+    print_work_table(user_name, fetch_term_desc(work_store.terms(), term_id), term_id, dropped, limit=args.n)
+    if user is not None:
+        save_user_data(user)
+
+
+def print_work_table(user_name, term_desc, term_id, dropped, limit=None):
+    """从本地 work 表读取并打印 term_id 学期的未完成作业。
+    limit 不为 None 时只输出最近截止的 limit 个未过期作业。
+    """
+    dropped_course = [get_course_alias(x.courseName) for x in dropped]
+    if limit is not None:
+        _, works = work_store.query_works(user_name, term_id=term_id, status=PENDING, limit=limit)
+    else:
+        works = work_store.unfinished_works(user_name, term_id)
+    has_work = set(x.courseName for x in work_store.unfinished_works(user_name, term_id))
+    no_work_course = [get_course_alias(c.courseName) for c in work_store.courses(user_name, term_id)
+                      if c.courseName not in has_work]
     tab_content = list()
-    for course_name in work_list.keys():
-        course_alias = get_course_alias(course_name)
-        works = work_list[course_name]
-        unfinished_works = [x for x in works if x.workStatus == "待做"]
-        if len(unfinished_works) == 0:
-            no_work_course.append(course_alias)
-            continue
-        for work in unfinished_works:
-            tab_content.append([
-                course_alias + "-" + work.workName,
-                work.endTime if work.endTime is not None else "未知"
-            ])
-    tab_content.sort(key=lambda x: x[1].timestamp() if isinstance(x[1], datetime) else 0x7fffffff)
-    print(f"当前学号：{user.userName}")
-    print(f"当前学期：{fetch_term_desc(term_id_list, term_id)}")
+    for x in works:
+        tab_content.append([
+            get_course_alias(x.courseName) + "-" + x.workName,
+            datetime.fromtimestamp(x.endTime, SHANGHAI_TZ).strftime(WORK_TIME_FORMAT) if x.endTime is not None else "未知"
+        ])
+    print(f"当前学号：{user_name}")
+    print(f"当前学期：{term_desc}")
     print(table(tab_content, ["名称", "截止时间"]))
     print()
     if len(no_work_course) != 0:
         print(f"{'、'.join(no_work_course)}没有未完成作业。")
-    save_user_data(user)
+    if len(dropped_course) != 0:
+        print(f"{'、'.join(dropped_course)}获取失败，已略过。")
+
+
+def print_history_table(user, history):
+    term_desc = dict(user.get_term_id_list())
+    tab_content = list()
+    for term_id in sorted(history.keys(), reverse=True):
+        course_works = history[term_id]
+        works = [w for _, ws in course_works for w in ws]
+        unfinished = [w for w in works if w.workStatus == "待做"]
+        tab_content.append([term_desc.get(term_id, str(term_id)), len(course_works), len(works), len(unfinished)])
+    print(f"当前学号：{user.userName}")
+    print(table(tab_content, ["学期", "课程数", "作业数", "未完成"]))
 
 
 def web():
     import webbrowser
     from . import server
+    check_available()
     webbrowser.open("http://localhost:5986/")
     server.main()
 
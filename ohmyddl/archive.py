@@ -0,0 +1,61 @@
+"""历史学期归档。
+
+往届学期的课程和作业不会再变化，获取一次后按 (学号, 学期) 保存在本地，之后只刷新当前学期。
+"""
+import sqlite3
+import time
+from typing import Dict
+
+from . import serialization
+from .cachemanager import commit, connect_db
+
+
+class TermArchive:
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def connect(self) -> sqlite3.Connection:
+        conn = connect_db(self.db_path)
+        TermArchive.create_table(conn)
+        return conn
+
+    @staticmethod
+    def create_table(conn: sqlite3.Connection):
+        conn.execute("create table if not exists term_archive(user_name text, term_id integer, "
+                     "fetch_time integer, val blob, primary key(user_name, term_id));")
+
+    def save(self, user_name, term_id, course_works):
+        """保存一个学期的 [(CourseInfo, [WorkInfo, ...]), ...]
+        """
+        conn = self.connect()
+        try:
+            conn.execute("insert or replace into term_archive(user_name, term_id, fetch_time, val)values(?,?,?,?);",
+                         (user_name, term_id, int(time.time()), serialization.dumps(course_works)))
+            commit(conn)
+        finally:
+            conn.close()
+
+    def terms(self, user_name) -> Dict[int, int]:
+        """已归档的学期 {term_id: 获取时间}
+        """
+        conn = self.connect()
+        try:
+            rows = conn.execute("select term_id, fetch_time from term_archive where user_name=?;",
+                                (user_name, )).fetchall()
+        finally:
+            conn.close()
+        return dict(rows)
+
+    def load(self, user_name, term_ids=None) -> Dict[int, list]:
+        """读取归档 {term_id: [(CourseInfo, [WorkInfo, ...]), ...]}，term_ids 为 None 时读取全部学期。
+        """
+        conn = self.connect()
+        try:
+            rows = conn.execute("select term_id, val from term_archive where user_name=?;",
+                                (user_name, )).fetchall()
+        finally:
+            conn.close()
+        return {
+            term_id: serialization.loads(val) for term_id, val in rows
+            if term_ids is None or term_id in term_ids
+        }
@@ -1,52 +1,381 @@
+import contextlib
 import functools
-import pickle
+import logging
 import time
 from functools import wraps
 import sqlite3
+import threading
+import zlib
+
+from . import metrics, serialization
+from .exceptions import CircuitOpenError
 
 # from .models import ChaoxingUser
 
+# 缓存范围：每个用户独立、所有用户共用
+SCOPE_USER = "user"
+SCOPE_GLOBAL = "global"
+
+# 缓存值压缩：超过 COMPRESS_THRESHOLD 字节的值用 COMPRESS_CODEC（"zlib"、"lzma" 或 "none"）压缩。
+# 写入的值以一个字节开头，记录压缩方式；以 0x80 开头的是旧版本写入的未压缩 pickle
+COMPRESS_CODEC = "zlib"
+COMPRESS_THRESHOLD = 512
+ZLIB_LEVEL = 6
+CODEC_NONE = b"\x00"
+CODEC_ZLIB = b"\x01"
+CODEC_LZMA = b"\x02"
+LEGACY_PICKLE = 0x80
+
+# 数据库被其他进程（命令行、服务器）锁定时最多等待的时间，单位：秒
+BUSY_TIMEOUT = 10
+
+logger = logging.getLogger(__name__)
+_stats_lock = threading.Lock()
+_stats = {
+    "writes": 0, "compressed": 0, "raw_bytes": 0, "stored_bytes": 0, "compress_seconds": 0.0,
+    "reads": 0, "decompress_seconds": 0.0
+}
+# 本进程对数据库的提交次数
+_commits = 0
+# load_value 无法反序列化时的返回值
+MISS = object()
+
+# 缓存装饰器的命中情况，按被装饰的方法统计。淘汰指读到的缓存已过期（expired）或无法反序列化（undecodable）
+cache_hits = metrics.Counter("ohmyddl_cache_hits_total", "缓存命中次数", ["method"])
+cache_misses = metrics.Counter("ohmyddl_cache_misses_total", "缓存未命中次数（不含 disable_cache）", ["method"])
+cache_evictions = metrics.Counter("ohmyddl_cache_evictions_total", "读取时被丢弃的缓存数", ["method", "reason"])
+
+# 共用缓存同一时间只允许一个调用真正执行，其余调用等待其结果
+_flight_locks = dict()
+_flight_locks_lock = threading.Lock()
+
+
+def scoped_cache_id(scope, key=None):
+    """根据缓存范围生成 cache_id。学号只包含数字，因此共用缓存以 @ 开头不会与用户缓存冲突。
+    """
+    if scope == SCOPE_USER:
+        return key
+    elif scope == SCOPE_GLOBAL:
+        return "@global"
+    raise ValueError(f"invalid scope: {scope}")
+
+
+def connect_db(db_path, **kwargs) -> sqlite3.Connection:
+    """打开缓存数据库。使用 WAL 日志，读写互不阻塞；写入冲突时等待 BUSY_TIMEOUT 秒而不是立即报
+    "database is locked"；synchronous=NORMAL 在 WAL 下不会损坏数据库，只是断电时可能丢失最后的事务。
+    """
+    conn = sqlite3.connect(str(db_path), timeout=BUSY_TIMEOUT, **kwargs)
+    conn.execute(f"pragma busy_timeout={int(BUSY_TIMEOUT * 1000)};")
+    conn.execute("pragma journal_mode=WAL;")
+    conn.execute("pragma synchronous=NORMAL;")
+    return conn
+
+
+def commit(conn: sqlite3.Connection):
+    """提交事务并计数
+    """
+    global _commits
+    conn.commit()
+    with _stats_lock:
+        _commits += 1
+
+
+def commit_count() -> int:
+    with _stats_lock:
+        return _commits
+
+
+def _flight_lock(cache_id, key_str):
+    with _flight_locks_lock:
+        k = (cache_id, key_str)
+        if k not in _flight_locks:
+            _flight_locks[k] = threading.Lock()
+        return _flight_locks[k]
+
+
+def configure(codec=None, threshold=None):
+    """修改压缩方式和阈值，只影响之后写入的缓存。
+    """
+    global COMPRESS_CODEC, COMPRESS_THRESHOLD
+    if codec is not None:
+        if codec not in ("none", "zlib", "lzma"):
+            raise ValueError(f"invalid codec: {codec}")
+        COMPRESS_CODEC = codec
+    if threshold is not None:
+        COMPRESS_THRESHOLD = threshold
+
+
+def encode_value(value: bytes) -> bytes:
+    """按当前设置压缩，返回带压缩方式头的值。压缩后没有变小时保存原值。
+    """
+    codec = COMPRESS_CODEC
+    start = time.perf_counter()
+    data = CODEC_NONE + value
+    if codec != "none" and len(value) >= COMPRESS_THRESHOLD:
+        if codec == "zlib":
+            compressed = CODEC_ZLIB + zlib.compress(value, ZLIB_LEVEL)
+        else:
+            import lzma
+            compressed = CODEC_LZMA + lzma.compress(value)
+        if len(compressed) < len(data):
+            data = compressed
+    elapsed = time.perf_counter() - start
+    with _stats_lock:
+        _stats["writes"] += 1
+        _stats["compressed"] += data[:1] != CODEC_NONE
+        _stats["raw_bytes"] += len(value)
+        _stats["stored_bytes"] += len(data)
+        _stats["compress_seconds"] += elapsed
+    return data
+
+
+def decode_value(data: bytes) -> bytes:
+    """还原 encode_value 写入的值
+    """
+    data = bytes(data)
+    if not data or data[0] == LEGACY_PICKLE:
+        return data
+    start = time.perf_counter()
+    codec = data[:1]
+    if codec == CODEC_NONE:
+        value = data[1:]
+    elif codec == CODEC_ZLIB:
+        value = zlib.decompress(data[1:])
+    elif codec == CODEC_LZMA:
+        import lzma
+        value = lzma.decompress(data[1:])
+    else:
+        raise ValueError(f"unknown cache codec: {codec!r}")
+    elapsed = time.perf_counter() - start
+    with _stats_lock:
+        _stats["reads"] += 1
+        _stats["decompress_seconds"] += elapsed
+    return value
+
+
+def compression_stats():
+    """本进程写入、读取缓存时的压缩统计：节省的字节数与压缩、解压耗时（秒）
+    """
+    with _stats_lock:
+        result = dict(_stats)
+    result["codec"] = COMPRESS_CODEC
+    result["threshold"] = COMPRESS_THRESHOLD
+    result["saved_bytes"] = result["raw_bytes"] - result["stored_bytes"]
+    result["ratio"] = result["stored_bytes"] / result["raw_bytes"] if result["raw_bytes"] else 1.0
+    return result
+
+
+class PartialResult(list):
+    """不完整的结果（例如部分课程因超时被略过）。不会被写入缓存。
+
+    dropped 为被略过的项目。
+    """
+    def __init__(self, iterable=(), dropped=None):
+        super().__init__(iterable)
+        self.dropped = list(dropped) if dropped else []
+
+
+class WriteBatch:
+    """把一次刷新中的所有写入合并为一个事务。
+
+    写操作先保存在内存中，flush 时在同一个事务中依次执行，只提交一次。
+    不在刷新期间持有数据库的写锁，因此不会因等待上游而阻塞其他进程。
+    通过 CacheManager 写入的缓存在 flush 前也能读到。可在多个线程中同时使用。
+    flush 之后再添加的写操作立即单独执行。
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._ops = list()
+        # {(cache_id, key_str): (update_time, value)}
+        self._cache = dict()
+        self._flushed = False
+
+    def __len__(self):
+        return len(self._ops)
+
+    def add(self, op):
+        """op(conn) 在 flush 时执行，可返回一个在提交后调用的函数
+        """
+        with self._lock:
+            if not self._flushed:
+                self._ops.append(op)
+                return
+        self._execute([op])
+
+    def write_cache(self, cache_id, key_str, update_time, value):
+        def op(conn):
+            CacheManager.create_table(conn)
+            conn.execute("insert or replace into cache(cache_id, key_str, update_time, val)values(?,?,?,?);",
+                         (cache_id, key_str, int(update_time), encode_value(value)))
+        with self._lock:
+            if not self._flushed:
+                self._cache[(cache_id, key_str)] = (int(update_time), value)
+                self._ops.append(op)
+                return
+        self._execute([op])
+
+    def read_cache(self, cache_id, key_str):
+        """flush 前写入的缓存 (update_time, value)，没有时返回 None
+        """
+        with self._lock:
+            return self._cache.get((cache_id, key_str))
+
+    def flush(self):
+        with self._lock:
+            ops, self._ops = self._ops, list()
+            self._cache = dict()
+            self._flushed = True
+        self._execute(ops)
+
+    def _execute(self, ops):
+        if not ops:
+            return
+        callbacks = list()
+        conn = connect_db(self.db_path, isolation_level=None)
+        try:
+            conn.execute("begin immediate;")
+            try:
+                for op in ops:
+                    callback = op(conn)
+                    if callback is not None:
+                        callbacks.append(callback)
+                commit(conn)
+            except BaseException:
+                conn.execute("rollback;")
+                raise
+        finally:
+            conn.close()
+        logger.debug(f"write batch: {len(ops)} writes in one commit")
+        for callback in callbacks:
+            callback()
+
+
+@contextlib.contextmanager
+def write_batch(obj, db_path):
+    """with 块内 obj 的缓存方法（以及传入 obj._write_batch 的其他写操作）合并为一个事务，在退出时提交。
+    嵌套使用时沿用外层的批次。提交失败时只记录日志，与单独写入失败时的处理一致。
+    """
+    batch = getattr(obj, "_write_batch", None)
+    if batch is not None:
+        yield batch
+        return
+    batch = WriteBatch(db_path)
+    obj._write_batch = batch
+    try:
+        yield batch
+    finally:
+        obj._write_batch = None
+        try:
+            batch.flush()
+        except sqlite3.Error as e:
+            logger.error(f"write batch failed: {e}")
+
 
 class CacheManager:
-    def __init__(self, cache_id, data_file=None):
+    def __init__(self, cache_id, data_file=None, batch: WriteBatch = None):
         """cache_id 缓存ID
 
         data_file 数据库保存路径
+
+        batch 不为 None 时写入延迟到 batch.flush，读取时优先读取 batch 中未提交的值
         """
         self.cache_id = cache_id
-        self.conn = sqlite3.connect(":memory:" if data_file is None else data_file)
+        self.batch = batch
+        self.conn = connect_db(":memory:" if data_file is None else data_file)
         CacheManager.create_table(self.conn)
+        if self.conn.in_transaction:
+            commit(self.conn)
 
     @staticmethod
     def create_table(conn: sqlite3.dbapi2.Connection):
+        """每个 (cache_id, key_str) 只保存一行，写入时替换
+        """
         sql = "create table if not exists cache(id integer primary key, cache_id text, key_str text, update_time integer, val blob);"
         cursor = conn.cursor()
         cursor.execute(sql)
+        try:
+            cursor.execute("create unique index if not exists cache_key on cache(cache_id, key_str);")
+        except sqlite3.IntegrityError:
+            # 旧版本每次写入都新增一行，只保留每个缓存最后写入的一行
+            cursor.execute("delete from cache where id not in (select max(id) from cache group by cache_id, key_str);")
+            cursor.execute("create unique index if not exists cache_key on cache(cache_id, key_str);")
+            logger.info("removed duplicate cache rows")
         cursor.close()
 
     def read_cache(self, key_str, ttl):
+        """读取缓存，ttl 为 None 时不检查是否过期。
+        """
+        pending = self.batch.read_cache(self.cache_id, key_str) if self.batch is not None else None
+        if pending is not None:
+            if ttl is None or (time.time() - pending[0]) < ttl:
+                return pending[1]
+            return None
         cursor = self.conn.cursor()
-        sql = "select update_time, val from cache where cache_id=? and key_str=? order by update_time desc;"
+        sql = "select update_time, val from cache where cache_id=? and key_str=?;"
         cursor.execute(sql, (self.cache_id, key_str))
         t = cursor.fetchone()
+        cursor.close()
         if t is not None:
             update_time, val = t
             current_time = time.time()
-            if (current_time - update_time) < ttl:
-                return val
+            if ttl is None or (current_time - update_time) < ttl:
+                return decode_value(val)
         return None
 
+    def get_update_time(self, key_str):
+        """缓存的最后更新时间，没有缓存时返回 None
+        """
+        pending = self.batch.read_cache(self.cache_id, key_str) if self.batch is not None else None
+        if pending is not None:
+            return pending[0]
+        cursor = self.conn.cursor()
+        sql = "select update_time from cache where cache_id=? and key_str=?;"
+        cursor.execute(sql, (self.cache_id, key_str))
+        t = cursor.fetchone()
+        cursor.close()
+        return t[0] if t else None
+
     def write_cache(self, key_str, update_time, value):
+        if self.batch is not None:
+            self.batch.write_cache(self.cache_id, key_str, update_time, value)
+            return
         cursor = self.conn.cursor()
-        sql = "insert into cache(cache_id, key_str, update_time, val)values(?,?,?,?);"
-        cursor.execute(sql, (self.cache_id, key_str, int(update_time), value))
-        self.conn.commit()
+        sql = "insert or replace into cache(cache_id, key_str, update_time, val)values(?,?,?,?);"
+        cursor.execute(sql, (self.cache_id, key_str, int(update_time), encode_value(value)))
+        commit(self.conn)
         cursor.close()
 
 
-def cache(ttl, db_path):
+def load_value(val):
+    """反序列化缓存的值。数据模型变化后旧的 pickle 缓存可能无法反序列化，此时返回 MISS，按没有缓存处理。
+    """
+    try:
+        return serialization.loads(val)
+    except Exception as e:
+        logger.warning(f"cache decode failed, ignored: {e!r}")
+        return MISS
+
+
+def make_key_str(func_name, vargs, kwargs):
+    """生成缓存的 key_str。disable_cache 参数不影响 key_str，强制刷新后的结果会覆盖正常调用的缓存。
+    """
+    key_str = func_name
+    for x in vargs:
+        key_str += str(x)
+
+    for x in kwargs.keys():
+        if x == "disable_cache":
+            continue
+        key_str += str(x)
+        key_str += str(kwargs[x])
+    return key_str
+
+
+def cache(ttl, db_path, scope=SCOPE_USER, batch=False):
     """缓存函数返回值。在 ttl 时间内重复调用某个函数（且str(参数)相同）会使用上次的返回值。
         @ttl 缓存过期时间，单位：秒。
+        @scope 缓存范围。SCOPE_USER: 按学号区分；SCOPE_GLOBAL: 所有用户共用。
 
         例子：\n
         @cache(60)\n
@@ -57,29 +386,61 @@ def cache(ttl, db_path):
         如果在60s内，重复调用该函数，并且x,y,z值相同的情况下，会直接使用上次运行的返回值。
 
         在上述例子中，执行10次get_val(1, 2, 3)只消耗约1秒时间。
+
+        调用时传入 disable_cache=True 会跳过缓存，并用新的返回值更新缓存。
+
+        上游熔断（CircuitOpenError）时，如果有过期的缓存，会返回过期的缓存。
+
+        this_object 有 _write_batch 属性（WriteBatch）时，缓存的写入合并到该批次中。
+        batch 为 True 时，调用期间的所有写入（包括返回值的缓存）合并为一个事务，见 write_batch。
     """
     def decorator(func):
+        def call(cm, key_str, this_object, *vargs, **kwargs):
+            if not kwargs.get("disable_cache", False):
+                old_val = cm.read_cache(key_str, ttl)
+                if old_val is not None:
+                    result = load_value(old_val)
+                    if result is not MISS:
+                        cache_hits.inc(func.__name__)
+                        return result
+                    cache_evictions.inc(func.__name__, "undecodable")
+                elif cm.get_update_time(key_str) is not None:
+                    cache_evictions.inc(func.__name__, "expired")
+                cache_misses.inc(func.__name__)
+            try:
+                result = func(this_object, *vargs, **kwargs)
+            except CircuitOpenError:
+                stale_val = cm.read_cache(key_str, None)
+                stale = MISS if stale_val is None else load_value(stale_val)
+                if stale is MISS:
+                    raise
+                return stale
+            if not isinstance(result, PartialResult):
+                val = serialization.dumps(result)
+                cm.write_cache(key_str, time.time(), val)
+            return result
+
         @wraps(func)
         def func_wraps(this_object, *vargs, **kwargs):
             # if not isinstance(this_object, ChaoxingUser):
             #     raise ValueError("you mush use this decorator in ChaoxingUser class")
-            cache_id = this_object.userName
-            key_str = func.__name__
-            for x in vargs:
-                key_str += str(x)
-
-            for x in kwargs.keys():
-                key_str += str(x)
-                key_str += str(kwargs[x])
-            cm = CacheManager(cache_id, db_path)
-            old_val = cm.read_cache(key_str, ttl)
-            if old_val is not None:
-                result = pickle.loads(old_val)
+            if scope == SCOPE_USER:
+                cache_id = scoped_cache_id(scope, this_object.userName)
             else:
-                result = func(this_object, *vargs, **kwargs)
-                val = pickle.dumps(result)
-                cm.write_cache(key_str, time.time(), val)
-            return result
+                cache_id = scoped_cache_id(scope)
+            key_str = make_key_str(func.__name__, vargs, kwargs)
+            if batch:
+                with write_batch(this_object, db_path):
+                    return locked_call(cache_id, key_str, this_object, *vargs, **kwargs)
+            return locked_call(cache_id, key_str, this_object, *vargs, **kwargs)
+
+        def locked_call(cache_id, key_str, this_object, *vargs, **kwargs):
+            cm = CacheManager(cache_id, db_path, batch=getattr(this_object, "_write_batch", None))
+            if scope == SCOPE_USER:
+                return call(cm, key_str, this_object, *vargs, **kwargs)
+            with _flight_lock(cache_id, key_str):
+                return call(cm, key_str, this_object, *vargs, **kwargs)
+
         return func_wraps
     return decorator
 
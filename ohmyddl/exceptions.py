@@ -14,3 +14,15 @@ class TryTooManyError(RuntimeError):
     """登录尝试次数过多
     """
     pass
+
+
+class BudgetExceededError(RuntimeError):
+    """操作超出时间预算
+    """
+    pass
+
+
+class CircuitOpenError(RuntimeError):
+    """上游连续出错，已熔断，暂不发出请求
+    """
+    pass
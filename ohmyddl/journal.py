@@ -0,0 +1,171 @@
+"""作业变化记录。
+
+每次从网页获取作业列表后，与上一次的快照比较，把新增、删除、起止时间变化、状态变化
+追加到 work_journal 表中。客户端可以只获取某个时间（或某条记录）之后的变化。
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+
+from .cachemanager import commit, connect_db
+from .utils import duplicate_ordinals
+
+
+# 变化类型
+NEW = "new"
+REMOVED = "removed"
+START_TIME = "start_time"
+DEADLINE = "deadline"
+STATUS = "status"
+
+# 快照中作业的 key 为 作业名称 + KEY_SEP + 第几个同名作业
+KEY_SEP = "\x00"
+
+logger = logging.getLogger(__name__)
+# 本进程记录到新变化时通知等待者
+_changed = threading.Condition()
+
+
+def wait_for_changes(timeout):
+    """等待本进程记录新的变化，最多等待 timeout 秒。其他进程（如命令行）记录的变化不会唤醒等待者。
+    """
+    with _changed:
+        _changed.wait(timeout)
+
+
+def make_snapshot(works) -> Dict[str, list]:
+    """{key: [startTime 时间戳, endTime 时间戳, workStatus]}。同一课程中可能有同名作业，
+    按 (作业名称, 第几个同名作业) 区分，见 work_key。
+    """
+    works = list(works)
+    ordinals = duplicate_ordinals([w.workName for w in works])
+    return {
+        work_key(w.workName, seq): [w.startTimestamp, w.endTimestamp, w.workStatus]
+        for w, seq in zip(works, ordinals)
+    }
+
+
+def work_key(work_name, seq) -> str:
+    return f"{work_name}{KEY_SEP}{seq}"
+
+
+def key_to_name(key) -> str:
+    return key.split(KEY_SEP, 1)[0]
+
+
+def diff_snapshot(old: Dict[str, list], new: Dict[str, list]) -> List[tuple]:
+    """比较两个快照，返回 [(kind, work_name, old_value, new_value), ...]
+    """
+    changes = list()
+    for key, (start, end, status) in new.items():
+        name = key_to_name(key)
+        if key not in old:
+            changes.append((NEW, name, None, json.dumps([start, end, status], ensure_ascii=False)))
+            continue
+        old_start, old_end, old_status = old[key]
+        if start != old_start:
+            changes.append((START_TIME, name, old_start, start))
+        if end != old_end:
+            changes.append((DEADLINE, name, old_end, end))
+        if status != old_status:
+            changes.append((STATUS, name, old_status, status))
+    for key in old.keys():
+        if key not in new:
+            changes.append((REMOVED, key_to_name(key), None, None))
+    return changes
+
+
+class WorkJournal:
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def connect(self) -> sqlite3.Connection:
+        conn = connect_db(self.db_path, isolation_level=None)
+        WorkJournal.create_table(conn)
+        return conn
+
+    @staticmethod
+    def create_table(conn: sqlite3.Connection):
+        conn.execute("create table if not exists work_snapshot(user_name text, class_id text, "
+                     "update_time integer, val text, primary key(user_name, class_id));")
+        conn.execute("create table if not exists work_journal(id integer primary key autoincrement, "
+                     "user_name text, time integer, kind text, course_id text, class_id text, "
+                     "work_name text, old text, new text);")
+        conn.execute("create index if not exists work_journal_user on work_journal(user_name, id);")
+
+    def record(self, user_name, course_id, class_id, works, batch=None) -> List[tuple]:
+        """保存 works 的快照，并记录与上一次快照的差异。第一次保存快照时不记录变化。
+        batch 不为 None 时加入批次，随批次一起提交，此时返回 None。
+
+        @return [(kind, work_name, old_value, new_value), ...]
+        """
+        snapshot = make_snapshot(works)
+        now = int(time.time())
+
+        def notify(changes):
+            logger.debug(f"{user_name} class {class_id} changes: {changes}")
+            with _changed:
+                _changed.notify_all()
+
+        if batch is not None:
+            def op(conn):
+                WorkJournal.create_table(conn)
+                changes = self._record(conn, user_name, course_id, class_id, snapshot, now)
+                return (lambda: notify(changes)) if changes else None
+            batch.add(op)
+            return None
+
+        conn = self.connect()
+        try:
+            conn.execute("begin immediate;")
+            changes = self._record(conn, user_name, course_id, class_id, snapshot, now)
+            commit(conn)
+        except Exception:
+            conn.execute("rollback;")
+            raise
+        finally:
+            conn.close()
+        if changes:
+            notify(changes)
+        return changes
+
+    @staticmethod
+    def _record(conn, user_name, course_id, class_id, snapshot, now) -> List[tuple]:
+        row = conn.execute("select val from work_snapshot where user_name=? and class_id=?;",
+                           (user_name, class_id)).fetchone()
+        changes = diff_snapshot(json.loads(row[0]), snapshot) if row is not None else []
+        conn.executemany(
+            "insert into work_journal(user_name, time, kind, course_id, class_id, work_name, old, new)"
+            "values(?,?,?,?,?,?,?,?);",
+            [(user_name, now, kind, course_id, class_id, name,
+              None if old is None else str(old), None if new is None else str(new))
+             for kind, name, old, new in changes])
+        conn.execute("insert or replace into work_snapshot(user_name, class_id, update_time, val)"
+                     "values(?,?,?,?);",
+                     (user_name, class_id, now, json.dumps(snapshot, ensure_ascii=False)))
+        return changes
+
+    def changes_since(self, user_name, since_time=0, since_id=0, limit=500) -> List[dict]:
+        """获取 since_time（时间戳）之后、且 id 大于 since_id 的变化，按 id 升序。
+        """
+        conn = self.connect()
+        try:
+            rows = conn.execute(
+                "select id, time, kind, course_id, class_id, work_name, old, new from work_journal "
+                "where user_name=? and id>? and time>=? order by id limit ?;",
+                (user_name, since_id, since_time, limit)).fetchall()
+        finally:
+            conn.close()
+        keys = ["id", "time", "kind", "courseId", "classId", "workName", "old", "new"]
+        return [dict(zip(keys, row)) for row in rows]
+
+    def last_id(self, user_name) -> int:
+        conn = self.connect()
+        try:
+            row = conn.execute("select max(id) from work_journal where user_name=?;", (user_name, )).fetchone()
+        finally:
+            conn.close()
+        return row[0] or 0
@@ -0,0 +1,210 @@
+"""进程内的运行指标，以 Prometheus 文本格式输出（服务器的 /metrics）。
+
+Counter、Gauge、Histogram 都可以在多个线程中使用。标签值按定义时 labelnames 的顺序传入，
+例如 Counter("x_total", "说明", ["route", "status"]).inc("/api/login", "200")。
+多进程运行时各进程分别统计：每个进程调用 share(目录, 进程名)，每隔 SHARE_INTERVAL 秒把本进程的数据写入该目录，
+render() 输出所有进程的数据，并加上标签 worker="进程名"。其他进程的数据最多晚 SHARE_INTERVAL 秒。
+"""
+import bisect
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import List
+
+from .utils import write_file_atomic
+
+
+# Histogram 默认的区间上限，单位：秒
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# 多进程运行时写入本进程数据的间隔，单位：秒
+SHARE_INTERVAL = 5
+
+logger = logging.getLogger(__name__)
+_lock = threading.Lock()
+_metrics: List["Metric"] = list()
+# share() 设置的目录和本进程的名称，未设置时只输出本进程的数据
+_share_dir = None
+_worker = None
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in zip(names, values)) + "}"
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = dict()
+        with _lock:
+            _metrics.append(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {labels}")
+        return tuple(str(x) for x in labels)
+
+    def samples(self) -> List[tuple]:
+        """[(名称后缀, 标签名, 标签值, 值), ...]
+        """
+        with self._lock:
+            return [("", self.labelnames, k, v) for k, v in sorted(self._values.items())]
+
+    def render(self, samples=None) -> str:
+        """samples 为 None 时输出 self.samples()
+        """
+        lines = [f"# HELP {self.name} {_escape(self.documentation)}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, names, values, value in self.samples() if samples is None else samples:
+            lines.append(f"{self.name}{suffix}{_format_labels(names, values)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """func 不为 None 时，输出时调用 func() 取值（没有标签）。
+    """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), func=None):
+        super().__init__(name, documentation, labelnames)
+        self.func = func
+
+    def set(self, value, *labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.func is None:
+            return super().samples()
+        try:
+            return [("", (), (), self.func())]
+        except Exception as e:
+            logger.error(f"metric {self.name} failed: {e}")
+            return []
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                # [各区间的个数（最后一个为超出所有区间的）, 总和]
+                item = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            item[0][i] += 1
+            item[1] += value
+
+    def samples(self):
+        names = self.labelnames + ("le",)
+        result = list()
+        with self._lock:
+            items = [(k, list(v[0]), v[1]) for k, v in sorted(self._values.items())]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                result.append(("_bucket", names, key + (_format_value(float(bound)),), cumulative))
+            result.append(("_sum", self.labelnames, key, total))
+            result.append(("_count", self.labelnames, key, cumulative))
+        return result
+
+
+def _snapshot():
+    with _lock:
+        metrics = list(_metrics)
+    return metrics, {m.name: m.samples() for m in metrics}
+
+
+def _dump(snapshot):
+    write_file_atomic(_share_dir / f"{_worker}.json", json.dumps(snapshot, ensure_ascii=False).encode("utf-8"))
+
+
+def _load_others():
+    """其他进程写入的数据，{进程名: {指标名称: 样本}}
+    """
+    result = dict()
+    for file in sorted(_share_dir.glob("*.json")):
+        if file.stem == _worker:
+            continue
+        try:
+            result[file.stem] = json.loads(file.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            logger.error(f"read metrics {file} failed: {e}")
+    return result
+
+
+def _share_loop():
+    while True:
+        try:
+            _dump(_snapshot()[1])
+        except Exception as e:
+            logger.error(f"write metrics failed: {e}")
+        time.sleep(SHARE_INTERVAL)
+
+
+def share(directory, worker):
+    """多进程运行时在每个进程中调用（fork 之后），worker 为进程名，重启的进程沿用原来的名称。
+    目录中的 <worker>.json 由该进程定期写入，目录由父进程在启动子进程前清空。
+    """
+    global _share_dir, _worker
+    _share_dir, _worker = Path(directory), str(worker)
+    threading.Thread(target=_share_loop, name="metrics-share", daemon=True).start()
+
+
+def render() -> str:
+    """所有指标的 Prometheus 文本格式。调用过 share() 时包含所有进程的数据
+    """
+    metrics, snapshot = _snapshot()
+    if _share_dir is None:
+        return "\n".join(m.render(snapshot[m.name]) for m in metrics) + "\n"
+    processes = _load_others()
+    processes[_worker] = snapshot
+    result = list()
+    for m in metrics:
+        samples = list()
+        for worker in sorted(processes):
+            for suffix, names, values, value in processes[worker].get(m.name, []):
+                samples.append((suffix, ["worker"] + list(names), [worker] + list(values), value))
+        result.append(m.render(samples))
+    return "\n".join(result) + "\n"
@@ -1,33 +1,282 @@
+import contextlib
 import functools
 import logging
 import pickle
+import random
 import time
-import re
+import sqlite3
+import urllib.parse as urlparse
+from array import array
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Dict, List, Tuple
 from pathlib import Path
 
-import lxml.etree
-import requests
-
-from .exceptions import LoginFailedError, PasswordError, TryTooManyError
-from .utils import extract_string, get_params_from_url
-from . import __version__
+from .exceptions import BudgetExceededError, CircuitOpenError, LoginFailedError, PasswordError, \
+    TryTooManyError
+from .utils import SHANGHAI_TZ, extract_string, get_params_from_url, lazy_import, parse_work_time, to_timestamp, \
+    write_file_atomic
+from . import __version__, metrics, parsers, serialization, throttle, transport
 from . import DATA_DIR
-from .cachemanager import make_cache_decorator
-
-
-WorkInfo = namedtuple(
+from .archive import TermArchive
+from .journal import WorkJournal
+from .store import WorkStore
+from .cachemanager import SCOPE_GLOBAL, PartialResult, make_cache_decorator, write_batch
+
+# 只在第一次联网时导入
+requests = lazy_import("requests")
+
+# 每次实际发出的请求（包括重试），status 为 HTTP 状态码，未收到响应时为 error
+upstream_requests = metrics.Counter("ohmyddl_upstream_requests_total", "上游请求次数", ["host", "endpoint", "status"])
+upstream_latency = metrics.Histogram("ohmyddl_upstream_request_duration_seconds", "上游请求耗时",
+                                     ["host", "endpoint"])
+login_attempts = metrics.Counter("ohmyddl_login_attempts_total", "登录次数")
+login_failures = metrics.Counter("ohmyddl_login_failures_total", "登录失败次数", ["reason"])
+
+_WorkInfo = namedtuple(
     "WorkInfo",
     [
         "workName", "startTime", "endTime", "workStatus",
-        "courseId", "classId", "workRelationId", "workRelationAnswerId", "workReEdit", "enc", "cpi"
+        "courseId", "classId", "workRelationId", "workRelationAnswerId", "workReEdit", "enc", "cpi",
+        "startTimestamp", "endTimestamp"
     ])
+_WorkInfo.__new__.__defaults__ = (None, None)
+
+
+class WorkInfo(_WorkInfo):
+    """startTime、endTime 为用于显示的北京时间，startTimestamp、endTimestamp 为对应的整数时间戳，
+    排序、比较、输出 JSON 时直接使用时间戳。时间戳省略时（包括读取旧版本的缓存时）由 startTime、endTime 计算。
+    """
+    __slots__ = ()
+
+    def __new__(cls, *args, **kwargs):
+        self = super().__new__(cls, *args, **kwargs)
+        if (self.startTimestamp is None and self.startTime is not None) \
+                or (self.endTimestamp is None and self.endTime is not None):
+            self = self._replace(startTimestamp=to_timestamp(self.startTime),
+                                 endTimestamp=to_timestamp(self.endTime))
+        return self
+
+
 CourseInfo = namedtuple(
     "CourseInfo", ["pageUrl", "courseName", "teacherName", "courseSeq"])
 
-cache = make_cache_decorator(DATA_DIR / Path("cache_data.db"))
+
+class WorkTable:
+    """一门课程的作业列表，按列保存。
+
+    courseId、classId、enc、cpi 对同一课程的所有作业都相同，只保存一份；起止时间保存为
+    array 中的整数时间戳；作业状态等重复出现的字符串经过 intern。
+    可以像 List[WorkInfo] 一样取长度、下标和遍历，取出时才生成 WorkInfo。
+    """
+    __slots__ = ("courseId", "classId", "enc", "cpi",
+                 "_names", "_start", "_end", "_status", "_relation_ids", "_re_edits")
+    # 没有时间时保存的值
+    NO_TIME = -(1 << 63)
+
+    def __init__(self, course_id=None, class_id=None, enc=None, cpi=None):
+        self.courseId = _intern(course_id)
+        self.classId = _intern(class_id)
+        self.enc = _intern(enc)
+        self.cpi = _intern(cpi)
+        self._names = list()
+        self._start = array("q")
+        self._end = array("q")
+        self._status = list()
+        # workRelationId 与 workRelationAnswerId 取自同一属性，只保存一份
+        self._relation_ids = list()
+        self._re_edits = list()
+
+    @classmethod
+    def from_works(cls, works) -> "WorkTable":
+        """由 List[WorkInfo] 生成。works 的 courseId、classId、enc、cpi 必须相同。
+        """
+        works = list(works)
+        header = (works[0].courseId, works[0].classId, works[0].enc, works[0].cpi) if works else (None, ) * 4
+        table = cls(*header)
+        for w in works:
+            if (w.courseId, w.classId, w.enc, w.cpi) != header or w.workRelationAnswerId != w.workRelationId:
+                raise ValueError(f"work {w.workName!r} can not be stored in WorkTable")
+            table.append(w.workName, w.startTimestamp, w.endTimestamp, w.workStatus, w.workRelationId, w.workReEdit)
+        return table
+
+    def append(self, work_name, start_timestamp, end_timestamp, work_status, work_relation_id=None,
+               work_re_edit=None):
+        self._names.append(work_name)
+        self._start.append(self.NO_TIME if start_timestamp is None else start_timestamp)
+        self._end.append(self.NO_TIME if end_timestamp is None else end_timestamp)
+        self._status.append(_intern(work_status))
+        self._relation_ids.append(work_relation_id)
+        self._re_edits.append(_intern(work_re_edit))
+
+    def with_status(self, work_status) -> "WorkTable":
+        """状态为 work_status 的作业组成的 WorkTable，不生成 WorkInfo
+        """
+        table = WorkTable(self.courseId, self.classId, self.enc, self.cpi)
+        for i, status in enumerate(self._status):
+            if status == work_status:
+                table._names.append(self._names[i])
+                table._start.append(self._start[i])
+                table._end.append(self._end[i])
+                table._status.append(status)
+                table._relation_ids.append(self._relation_ids[i])
+                table._re_edits.append(self._re_edits[i])
+        return table
+
+    # to_columns 导出的列数
+    COLUMN_COUNT = 2
+
+    def to_columns(self) -> list:
+        """按列导出，用于序列化。解析的耗时主要在生成字符串上，因此只分两列，状态也不逐个保存：
+        字符串列 [courseId, classId, enc, cpi, 取值表..., workName..., workRelationId...]，None 保存为 ""；
+        整数列 [作业数, 取值表长度, startTimestamp..., endTimestamp..., workStatus 在取值表中的下标...,
+        workReEdit 的下标..., 字符串列中为 None 的位置...]，没有的时间为 NO_TIME。
+        取值表为 workStatus、workReEdit 出现过的值，只有几种。
+        """
+        values = list(dict.fromkeys(self._status + self._re_edits))
+        index = {x: i for i, x in enumerate(values)}
+        strings = [self.courseId, self.classId, self.enc, self.cpi] + values + self._names + self._relation_ids
+        nones = [i for i, x in enumerate(strings) if x is None]
+        for i in nones:
+            strings[i] = ""
+        ints = array("q", [len(self), len(values)]) + self._start + self._end
+        ints.extend([index[x] for x in self._status])
+        ints.extend([index[x] for x in self._re_edits])
+        ints.extend(nones)
+        return [strings, ints]
+
+    @classmethod
+    def from_columns(cls, columns) -> "WorkTable":
+        strings, ints = columns
+        n, n_values = ints[0], ints[1]
+        for i in ints[2 + 4 * n:]:
+            strings[i] = None
+        values = _intern_all(strings[4:4 + n_values])
+        table = cls.__new__(cls)
+        table.courseId, table.classId, table.enc, table.cpi = _intern_all(strings[:4])
+        table._names = strings[4 + n_values:4 + n_values + n]
+        table._relation_ids = strings[4 + n_values + n:]
+        table._start = ints[2:2 + n]
+        table._end = ints[2 + n:2 + 2 * n]
+        table._status = list(map(values.__getitem__, ints[2 + 2 * n:2 + 3 * n]))
+        table._re_edits = list(map(values.__getitem__, ints[2 + 3 * n:2 + 4 * n]))
+        return table
+
+    def _row(self, i) -> WorkInfo:
+        start = self._start[i]
+        end = self._end[i]
+        start = None if start == self.NO_TIME else start
+        end = None if end == self.NO_TIME else end
+        return WorkInfo(
+            workName=self._names[i],
+            startTime=None if start is None else datetime.fromtimestamp(start, SHANGHAI_TZ),
+            endTime=None if end is None else datetime.fromtimestamp(end, SHANGHAI_TZ),
+            workStatus=self._status[i],
+            courseId=self.courseId,
+            classId=self.classId,
+            workRelationId=self._relation_ids[i],
+            workRelationAnswerId=self._relation_ids[i],
+            workReEdit=self._re_edits[i],
+            enc=self.enc,
+            cpi=self.cpi,
+            startTimestamp=start,
+            endTimestamp=end
+        )
+
+    def __len__(self):
+        return len(self._names)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._row(x) for x in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("WorkTable index out of range")
+        return self._row(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._row(i)
+
+    def __eq__(self, other):
+        if isinstance(other, (WorkTable, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return f"WorkTable(classId={self.classId!r}, {len(self)} works)"
+
+    def __getstate__(self):
+        return {x: getattr(self, x) for x in self.__slots__}
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            if k in ("_status", "_re_edits"):
+                v = [_intern(x) for x in v]
+            setattr(self, k, v)
+        for x in ("courseId", "classId", "enc", "cpi"):
+            setattr(self, x, _intern(getattr(self, x)))
+
+
+# 重复出现的字符串（状态、课程 ID 等）只保留一份
+_canonical = dict()
+
+
+def _intern(s):
+    return _canonical.setdefault(s, s) if isinstance(s, str) else s
+
+
+def _intern_all(items):
+    return list(map(_canonical.setdefault, items, items))
+
+
+# 缓存中学期列表、课程列表、作业列表的序列化方式，标记一经使用不可更改
+def _is_term_list(obj):
+    return isinstance(obj, list) and all(
+        type(x) is tuple and len(x) == 2 and isinstance(x[0], int) and isinstance(x[1], str) for x in obj)
+
+
+def _is_course_works(obj):
+    return isinstance(obj, list) and all(
+        type(x) is tuple and len(x) == 2 and isinstance(x[0], CourseInfo) and isinstance(x[1], WorkTable)
+        for x in obj)
+
+
+_encode_courses, _decode_courses = serialization.namedtuple_codec(CourseInfo)
+serialization.register(
+    b"T", _is_term_list,
+    lambda obj: [array("q", [x[0] for x in obj]), [x[1] for x in obj]],
+    lambda columns: list(zip(columns[0].tolist(), columns[1])))
+serialization.register(
+    b"C", lambda obj: isinstance(obj, list) and all(isinstance(x, CourseInfo) for x in obj),
+    _encode_courses, _decode_courses)
+serialization.register(
+    b"W", lambda obj: isinstance(obj, WorkTable), WorkTable.to_columns, WorkTable.from_columns)
+
+
+def _encode_course_works(obj):
+    columns = _encode_courses([c for c, _ in obj])
+    for _, works in obj:
+        columns.extend(works.to_columns())
+    return columns
+
+
+def _decode_course_works(columns):
+    n = len(columns[0]) + 1
+    n_works = WorkTable.COLUMN_COUNT
+    tables = [WorkTable.from_columns(columns[i:i + n_works]) for i in range(n, len(columns), n_works)]
+    return list(zip(_decode_courses(columns[:n]), tables))
+
+
+serialization.register(b"U", _is_course_works, _encode_course_works, _decode_course_works)
+
+CACHE_DB = DATA_DIR / Path("cache_data.db")
+cache = make_cache_decorator(CACHE_DB)
+work_journal = WorkJournal(CACHE_DB)
+term_archive = TermArchive(CACHE_DB)
+work_store = WorkStore(CACHE_DB)
 
 #
 # def cache_legacy(expire_time):
@@ -85,40 +334,154 @@ class ChaoxingUser:
         "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8,zh-TW;q=0.7"
     }
     CACHE_EXPIRE_TIME = 600
+    # 各接口的超时时间 (连接超时, 读取超时)，单位：秒。按 url 前缀匹配，取最长的前缀。
+    HTTP_TIMEOUTS = {
+        "https://oauth.shu.edu.cn/": (5, 15),
+        "http://shu.fysso.chaoxing.com/": (5, 15),
+        "http://www.elearning.shu.edu.cn/courselist/": (5, 20),
+        "http://mooc1.elearning.shu.edu.cn/work/": (5, 20),
+    }
+    HTTP_DEFAULT_TIMEOUT = (5, 10)
+    # 自动重试的退避时间：RETRY_BACKOFF_BASE * 2^n，最大 RETRY_BACKOFF_CAP 秒，并加入随机抖动。
+    RETRY_BACKOFF_BASE = 0.5
+    RETRY_BACKOFF_CAP = 8
+    # get_unfinish_work_list 的总时间预算，单位：秒
+    UNFINISH_WORK_BUDGET = 60
+    # fetch_history 同时获取的学期数
+    HISTORY_TERM_CONCURRENCY = 2
 
     def __init__(self, username, password):
         self.userName = username
         self.password = password
         self.session = requests.Session()
         self.session.headers.update(self.HTTP_HEADERS)
+        transport.mount(self.session)
         self._logger = logging.getLogger(__name__)
         self._cache_table: Dict[str, Tuple[List, float]] = dict()
         # 如果该对象是通过load_from产生的，load_file 为其来源文件，否则 load_from 为空。
         self.load_file = ""
         self.last_update_time = 0
         self.version = __version__
+        # time_budget 设置的截止时间（time.monotonic()），None 表示不限制。
+        self._deadline = None
+        # write_batch 期间的 WriteBatch，None 表示直接写入。
+        self._write_batch = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_write_batch"] = None
+        return state
+
+    def get_timeout(self, url) -> Tuple[float, float]:
+        """获取 url 对应的 (连接超时, 读取超时)
+        """
+        matched = ""
+        timeout = self.HTTP_DEFAULT_TIMEOUT
+        for prefix, value in self.HTTP_TIMEOUTS.items():
+            if url.startswith(prefix) and len(prefix) > len(matched):
+                matched = prefix
+                timeout = value
+        return timeout
+
+    def backoff_delay(self, attempt) -> float:
+        """第 attempt 次（从0开始）重试前的等待时间。在 [d/2, d] 之间随机取值，避免多个请求同时重试。
+        """
+        d = min(self.RETRY_BACKOFF_CAP, self.RETRY_BACKOFF_BASE * (2 ** attempt))
+        return d / 2 + random.uniform(0, d / 2)
+
+    def remaining_budget(self):
+        """当前时间预算的剩余秒数，没有预算时返回 None
+        """
+        if self._deadline is None:
+            return None
+        return self._deadline - time.monotonic()
+
+    @contextlib.contextmanager
+    def time_budget(self, seconds):
+        """限制 with 块内所有网络请求的总耗时，超出后 http_request 抛出 BudgetExceededError。
+        嵌套使用时以更早的截止时间为准。
+        """
+        old_deadline = self._deadline
+        deadline = time.monotonic() + seconds
+        if old_deadline is not None:
+            deadline = min(deadline, old_deadline)
+        self._deadline = deadline
+        try:
+            yield
+        finally:
+            self._deadline = old_deadline
 
-    def http_request(self, url, method, params=None, data=None, referer=None, auto_retry=3) -> requests.models.Response:
+    def write_batch(self):
+        """with 块内的缓存、作业存储等写入合并为一个事务，在退出时提交。
+        """
+        return write_batch(self, CACHE_DB)
+
+    def http_request(self, url, method, params=None, data=None, referer=None, auto_retry=3,
+                     timeout=None) -> "requests.models.Response":
         session = self.session
         if referer:
             session.headers.update({
                 "Referer": referer
             })
+        if timeout is None:
+            timeout = self.get_timeout(url)
+        parsed_url = urlparse.urlparse(url)
+        host = parsed_url.hostname
+        endpoint = parsed_url.path or "/"
+        limiter = throttle.get_limiter(host)
+        breaker = throttle.get_breaker(host)
         request = getattr(session, method.lower())
+        attempt = 0
         while True:
+            remaining = self.remaining_budget()
+            if remaining is not None and remaining <= 0:
+                raise BudgetExceededError(f"超出时间预算：{url}")
+            if not limiter.acquire(timeout=remaining):
+                raise BudgetExceededError(f"超出时间预算（限流等待）：{url}")
+            # 半开状态下 allow 会占用唯一的试探机会，之后必须发出请求并记录结果
+            if not breaker.allow():
+                raise CircuitOpenError(f"{host} 连续出错，暂停请求")
+            remaining = self.remaining_budget()
+            if remaining is not None:
+                # 单次请求的超时不超过剩余预算
+                real_timeout = (min(timeout[0], remaining), min(timeout[1], remaining))
+            else:
+                real_timeout = timeout
+            start = time.perf_counter()
             try:
-                r = request(url, params=params, data=data)
-                return r
+                r = request(url, params=params, data=data, timeout=real_timeout)
             except requests.exceptions.RequestException as e:
+                upstream_requests.inc(host, endpoint, "error")
+                upstream_latency.observe(time.perf_counter() - start, host, endpoint)
                 self._logger.error(f"请求时发生错误：{e}")
                 if isinstance(e, ValueError):
+                    breaker.record_success()
                     raise
+                breaker.record_failure()
                 if auto_retry > 0:
-                    time.sleep(1)
+                    delay = self.backoff_delay(attempt)
+                    remaining = self.remaining_budget()
+                    if remaining is not None and delay >= remaining:
+                        raise BudgetExceededError(f"超出时间预算：{url}") from e
+                    time.sleep(delay)
                     self._logger.error(f"自动重试: {auto_retry}")
                     auto_retry -= 1
+                    attempt += 1
                 else:
                     raise
+            except BaseException:
+                # 不是上游的问题（例如被中断），不影响熔断状态，但要交还试探机会
+                breaker.release()
+                raise
+            else:
+                upstream_requests.inc(host, endpoint, r.status_code)
+                upstream_latency.observe(time.perf_counter() - start, host, endpoint)
+                # 429 和 5xx 视为上游出错
+                if r.status_code == 429 or r.status_code >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                return r
 
     def http_get(self, url, **kargs):
         return self.http_request(url, "get", **kargs)
@@ -147,6 +510,23 @@ class ChaoxingUser:
             return False
 
     def login(self):
+        login_attempts.inc()
+        try:
+            self._login()
+        except PasswordError:
+            login_failures.inc("password")
+            raise
+        except TryTooManyError:
+            login_failures.inc("too_many")
+            raise
+        except LoginFailedError:
+            login_failures.inc("unexpected_page")
+            raise
+        except Exception:
+            login_failures.inc("error")
+            raise
+
+    def _login(self):
         # step 1
         r = self.http_get("http://shu.fysso.chaoxing.com/sso/shu",
                           referer="http://www.elearning.shu.edu.cn/portal")
@@ -174,14 +554,9 @@ class ChaoxingUser:
 
         # step 3
         # r.url start with http://www.elearning.shu.edu.cn/sso/logind
-        html = lxml.etree.HTML(r.text)
-        form = html.xpath("//form[@id='userLogin']")[0]
-        inputs = form.xpath("input[@type='hidden']")
-        request_url = form.attrib["action"]
+        request_url, inputs = parsers.parse(parsers.parse_login_form, r.text)
         data = dict()
-        for i in inputs:
-            name = i.attrib["name"]
-            value = i.attrib["value"]
+        for name, value in inputs:
             data[name] = value
             if name == "fid":
                 fid = value
@@ -195,9 +570,9 @@ class ChaoxingUser:
         self.http_get(
             "http://www.elearning.shu.edu.cn/setcookie.jsp", params=params)
 
-    @cache(86400)
+    @cache(86400, scope=SCOPE_GLOBAL)
     def get_term_id_list(self, disable_cache=False) -> List[Tuple[int, str]]:
-        """获取学期id
+        """获取学期id。所有学生的学期列表相同，缓存由所有用户共用。
         @return [(20193, "2019-2020学年春季学期"), (20192, "2019-2020学年秋季学期"), ...]
         """
         # step 1 获取请求url
@@ -209,13 +584,7 @@ class ChaoxingUser:
         # step 2
         result = list()
         r = self.http_get(url)
-        html = lxml.etree.HTML(r.text)
-        term_list_li = html.xpath(
-            "//ul[@class='zse_ul']/li[@class='zse_li']/a")
-        for x in term_list_li:
-            year = x.xpath("@data_year")[0]
-            term = x.xpath("@data_term")[0]
-            comment = x.text.strip()
+        for year, term, comment in parsers.parse(parsers.parse_term_list, r.text):
             try:
                 term_id = int(year + term)
             except ValueError as e:
@@ -224,6 +593,10 @@ class ChaoxingUser:
             result.append((term_id, comment))
         result.sort(key=lambda x: x[0], reverse=True)
         self._logger.info(f"term_id: {result}")
+        try:
+            work_store.save_terms(result, batch=self._write_batch)
+        except sqlite3.Error as e:
+            self._logger.error(f"保存学期失败：{e}")
         return result
 
     @cache(86400)
@@ -257,25 +630,18 @@ class ChaoxingUser:
         self._logger.debug(f"get_course_list term_id: {term_id}")
 
         r = self.http_get(url, params=request_data)
-        html = lxml.etree.HTML(r.text)
-        courses = html.xpath("//li[contains(@class, 'zmy_item')]")
-        course_list = list()
-        for c in courses:
-            course_list.append(CourseInfo(
-                pageUrl=c.xpath("a/@href")[0],
-                courseName=c.xpath(
-                    "dl/dt[@name='courseNameHtml']")[0].text.strip(),
-                teacherName=c.xpath(
-                    "dl/dd[@name='userNameHtml']")[0].text.strip(),
-                courseSeq=c.xpath("dl/dt/span/text()")[0].strip()[1:-1]
-            ))
+        course_list = [CourseInfo._make(x) for x in parsers.parse(parsers.parse_course_list, r.text)]
+        if term_id != 0:
+            try:
+                work_store.save_courses(self.userName, term_id, course_list, batch=self._write_batch)
+            except sqlite3.Error as e:
+                self._logger.error(f"保存课程失败：{e}")
         return course_list
 
     @cache(600)
-    def get_work_list(self, page_url, disable_cache=False) -> List[WorkInfo]:
+    def get_work_list(self, page_url, disable_cache=False) -> WorkTable:
         """获取作业列表
         """
-        result = list()
         r = self.http_get(page_url)
         # step 1 获取url
         request_path = extract_string(r.text, "/work/getAllWork?")
@@ -289,84 +655,110 @@ class ChaoxingUser:
 
         # step 2
         r = self.http_get(request_url)
-        # 获取参数 enc
-        # r.text 有如下一段，从里面提取参数 enc.
-        # 注意，这个 enc 和 request_url 里面的 enc 并不一致。
-        """
-        url = "/work/doHomeWorkNew?courseId=" + courseId + "&classId=" + classId + "&workId=" + workRelationId + "&workAnswerId="
-                + workRelationAnswerId + "&isdisplaytable=2&mooc=1&enc=f7b9e17b6c978b006dea24fcc54cbbe7&workSystem=0&cpi=64590381&standardEnc=";
-            } else if (redit == 1) {
-                url = "/work/doHomeWorkNew?courseId=" + courseId + "&classId=" + classId + "&workId=" + workRelationId + "&workAnswerId=" 
-                    + workRelationAnswerId + "&reEdit=1&isdisplaytable=2&mooc=1&enc=f7b9e17b6c978b006dea24fcc54cbbe7&workSystem=0&cpi=64590381&standardEnc=";
-            }
-        """
-        enc = None
-        try:
-            temp = r.text.index("/work/doHomeWorkNew")
-            substr = r.text[temp:temp + 500]
-            enc_list = re.findall("&enc=(.*?)&", substr)
-            if enc_list:
-                enc = enc_list[0]
-        except ValueError as e:
-            self._logger.debug(f"获取 enc 失败：{e}")
-        # 获取 enc 完成
-
-        html = lxml.etree.HTML(r.text)
-        works = html.xpath("//div[@class='ulDiv']/ul/li")
+        enc, works = parsers.parse(parsers.parse_work_list, r.text)
         self._logger.info(f"get_work_list len(works) = {len(works)}")
-        for x in works:
-            work_name = x.xpath("div[@class='titTxt']/p/a/@title")[0]
-            # 处理时间
-            # t[0] - startTime, t[1] - endTime
-            t = x.xpath("div[@class='titTxt']/span[@class='pt5']/text()")
-            # 去除空格
-            t = [i.strip() for i in t]
-            time_format = r"%Y-%m-%d %H:%M"
-            start_time = datetime.strptime(t[0], time_format) if t[0] else None
-            end_tim = datetime.strptime(t[1], time_format) if t[1] else None
-            # 作业状态
-            work_status = x.xpath(
-                "div[@class='titTxt']/span/strong")[0].text.strip()
-
-            work_action_button = x.xpath(".//span[contains(text(), '做作业')]/..")
-            work_relation_id = None
-            work_relation_answer_id = None
-            work_re_edit = None
-            if work_action_button:
-                work_action_button = work_action_button[0]
-                work_relation_id = work_action_button.attrib.get("data")
-                work_relation_answer_id = work_action_button.attrib.get("data")
-                work_re_edit = work_action_button.attrib.get("data3")
-
-            result.append(WorkInfo(
-                workName=work_name,
-                startTime=start_time,
-                endTime=end_tim,
-                workStatus=work_status,
-                courseId=course_id,
-                classId=class_id,
-                workRelationId=work_relation_id,
-                workRelationAnswerId=work_relation_answer_id,
-                workReEdit=work_re_edit,
-                enc=enc,
-                cpi=cpi
-            ))
+        result = WorkTable(course_id, class_id, enc, cpi)
+        for name, start, end, work_status, work_relation_id, work_re_edit in works:
+            result.append(name, to_timestamp(parse_work_time(start)) if start else None,
+                          to_timestamp(parse_work_time(end)) if end else None,
+                          work_status, work_relation_id, work_re_edit)
+        try:
+            work_journal.record(self.userName, course_id, class_id, result, batch=self._write_batch)
+            work_store.save_works(self.userName, page_url, result, batch=self._write_batch)
+        except sqlite3.Error as e:
+            self._logger.error(f"保存作业失败：{e}")
         return result
 
-    @cache(600)
-    def get_unfinish_work_list(self, term_id=-1, disable_cache=False):
+    def fetch_work_lists(self, course_list, disable_cache=False) \
+            -> Tuple[List[Tuple[CourseInfo, List[WorkInfo]]], List[CourseInfo]]:
+        """并发获取多门课程的作业列表，线程数为 transport.FETCH_CONCURRENCY。
+        超出时间预算、或者上游熔断且没有缓存的课程会被略过。
+
+        @return ([(CourseInfo, [WorkInfo, ...]), ...], [被略过的 CourseInfo, ...])
+        """
+        result = list()
+        dropped = list()
+        with ThreadPoolExecutor(max_workers=transport.FETCH_CONCURRENCY) as executor:
+            futures = [
+                executor.submit(self.get_work_list, course.pageUrl, disable_cache=disable_cache)
+                for course in course_list
+            ]
+            for course, future in zip(course_list, futures):
+                try:
+                    result.append((course, future.result()))
+                except (BudgetExceededError, CircuitOpenError) as e:
+                    self._logger.error(f"{e}，略过课程：{course.courseName}")
+                    dropped.append(course)
+        self._logger.debug(f"连接复用率：{transport.reuse_rate():.0%}, {transport.stats()}")
+        return result, dropped
+
+    @cache(600, batch=True)
+    def get_unfinish_work_list(self, term_id=-1, disable_cache=False, budget=None):
         """获取未完成作业。即状态为：待做
-        @return [(CourseInfo, [WorkInfo, ...]), ...]
+        @params budget 总时间预算，单位：秒。默认为 UNFINISH_WORK_BUDGET。
+        超出预算或上游熔断的课程会被略过，此时返回 PartialResult，dropped 为被略过的 CourseInfo。
+        一次刷新的所有写入在返回后合并为一个事务提交。
+
+        @return [(CourseInfo, WorkTable), ...]
         """
-        course_list = self.get_course_list(
-            term_id=term_id, disable_cache=disable_cache)
+        if budget is None:
+            budget = self.UNFINISH_WORK_BUDGET
+        with self.time_budget(budget):
+            course_list = self.get_course_list(
+                term_id=term_id, disable_cache=disable_cache)
+            work_lists, dropped = self.fetch_work_lists(
+                course_list, disable_cache=disable_cache)
         result = list()
-        for course in course_list:
-            work_list = self.get_work_list(
-                course.pageUrl, disable_cache=disable_cache)
-            unfinished_works = [x for x in work_list if x.workStatus == "待做"]
+        for course, work_list in work_lists:
+            if not isinstance(work_list, WorkTable):
+                # 旧版本缓存中的作业列表为 List[WorkInfo]
+                work_list = WorkTable.from_works(work_list)
+            unfinished_works = work_list.with_status("待做")
             if unfinished_works:
                 result.append((course, unfinished_works))
+        if dropped:
+            return PartialResult(result, dropped=dropped)
+        return result
+
+    def fetch_history(self, disable_cache=False) -> Dict[int, List[Tuple[CourseInfo, List[WorkInfo]]]]:
+        """获取所有学期的课程和作业，并发获取 HISTORY_TERM_CONCURRENCY 个学期。
+        往届学期获取一次后保存到本地归档，之后直接读取归档；当前学期每次都重新获取（仍会使用缓存）。
+        disable_cache 为 True 时重新获取所有学期。
+
+        获取失败（包括有课程被略过）的学期使用本地归档，没有归档时不包含在内；一个学期失败不影响其他学期。
+
+        @return {term_id: [(CourseInfo, [WorkInfo, ...]), ...]}
+        """
+        term_id_list = self.get_term_id_list(disable_cache=disable_cache)
+        term_ids = [t for t, _ in term_id_list if t // 10000 == 2]
+        current_term = term_ids[0] if term_ids else None
+        archived = term_archive.terms(self.userName)
+        todo = [t for t in term_ids if disable_cache or t == current_term or t not in archived]
+        self._logger.info(f"fetch_history terms: {todo}, archived: {list(archived.keys())}")
+
+        def fetch_term(term_id):
+            course_list = self.get_course_list(term_id=term_id, disable_cache=disable_cache)
+            course_works, dropped = self.fetch_work_lists(course_list, disable_cache=disable_cache)
+            if not dropped:
+                term_archive.save(self.userName, term_id, course_works)
+            return course_works, dropped
+
+        result = term_archive.load(self.userName, [t for t in term_ids if t not in todo])
+        with ThreadPoolExecutor(max_workers=self.HISTORY_TERM_CONCURRENCY) as executor:
+            futures = [(t, executor.submit(fetch_term, t)) for t in todo]
+            for term_id, future in futures:
+                try:
+                    course_works, dropped = future.result()
+                except Exception as e:
+                    error = repr(e)
+                else:
+                    if not dropped:
+                        result[term_id] = course_works
+                        continue
+                    error = f"{len(dropped)} 门课程获取失败：{[x.courseName for x in dropped]}"
+                self._logger.error(f"获取学期 {term_id} 失败：{error}")
+                if term_id in archived:
+                    result.update(term_archive.load(self.userName, [term_id]))
         return result
 
     def dump_to(self, file_path=None):
@@ -375,10 +767,15 @@ class ChaoxingUser:
         if file_path is None:
             raise ValueError("need param file_path")
         self._logger.debug(f"dump object to {file_path}")
-        with open(file_path, "wb") as f:
-            # 避开 python3.6 的一个 bug, 参考：https://bugs.python.org/issue30520
-            del self._logger
-            pickle.dump(self, f)
+        # 避开 python3.6 的一个 bug, 参考：https://bugs.python.org/issue30520
+        logger = self._logger
+        del self._logger
+        try:
+            data = pickle.dumps(self)
+        finally:
+            self._logger = logger
+        # 命令行与服务器可能同时保存，加锁并整体替换，避免文件被写坏
+        write_file_atomic(file_path, data)
 
     @staticmethod
     def load_from(file_path):
@@ -387,4 +784,9 @@ class ChaoxingUser:
             obj.load_file = file_path
             if not hasattr(obj, "_logger"):
                 obj._logger = logging.getLogger(__name__)
+            if not hasattr(obj, "_deadline"):
+                obj._deadline = None
+            if not hasattr(obj, "_write_batch"):
+                obj._write_batch = None
+            transport.mount(obj.session)
             return obj
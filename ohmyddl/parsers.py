@@ -0,0 +1,197 @@
+"""网页解析。
+
+解析函数都是纯函数：输入网页文本，返回由 str、None 组成的元组（列表），不引用 lxml 的对象，
+因此可以在其他进程中执行，结果也可以直接缓存。
+
+parse(func, text) 调用解析函数。configure(processes=N) 后，不小于 INLINE_THRESHOLD 的网页交给
+N 个进程的进程池解析，多个用户同时刷新时解析不会在 GIL 上排队；较小的网页、未启用进程池、
+以及进程池不可用时，直接在当前线程解析。
+"""
+import atexit
+import logging
+import re
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from .utils import lazy_import
+
+etree = lazy_import("lxml.etree")
+
+# 进程池的进程数，0 表示不使用进程池
+PROCESSES = 0
+# 小于该长度（字符数）的网页直接在当前线程解析：传给子进程的开销比解析本身大
+INLINE_THRESHOLD = 16 * 1024
+
+logger = logging.getLogger(__name__)
+_lock = threading.Lock()
+_pool = None
+_stats = {
+    "inline": 0,
+    "pool": 0,
+    "fallback": 0,
+    "queue_seconds": 0.0,
+    "max_queue_seconds": 0.0,
+    "parse_seconds": 0.0,
+}
+
+
+def parse_login_form(text) -> Tuple[str, List[Tuple[str, str]]]:
+    """统一认证跳转页中的登录表单
+    @return (action, [(name, value), ...])，value 为隐藏的 input
+    """
+    html = etree.HTML(text)
+    form = html.xpath("//form[@id='userLogin']")[0]
+    inputs = form.xpath("input[@type='hidden']")
+    return str(form.attrib["action"]), [(str(i.attrib["name"]), str(i.attrib["value"])) for i in inputs]
+
+
+def parse_term_list(text) -> List[Tuple[str, str, str]]:
+    """课程列表页中的学期
+    @return [(data_year, data_term, 学期名称), ...]
+    """
+    html = etree.HTML(text)
+    term_list_li = html.xpath("//ul[@class='zse_ul']/li[@class='zse_li']/a")
+    return [(str(x.xpath("@data_year")[0]), str(x.xpath("@data_term")[0]), x.text.strip()) for x in term_list_li]
+
+
+def parse_course_list(text) -> List[Tuple[str, str, str, str]]:
+    """课程列表
+    @return [(pageUrl, courseName, teacherName, courseSeq), ...]
+    """
+    html = etree.HTML(text)
+    courses = html.xpath("//li[contains(@class, 'zmy_item')]")
+    return [
+        (
+            str(c.xpath("a/@href")[0]),
+            c.xpath("dl/dt[@name='courseNameHtml']")[0].text.strip(),
+            c.xpath("dl/dd[@name='userNameHtml']")[0].text.strip(),
+            c.xpath("dl/dt/span/text()")[0].strip()[1:-1]
+        )
+        for c in courses
+    ]
+
+
+def parse_work_list(text) -> Tuple[Optional[str], List[tuple]]:
+    """作业列表页
+    @return (enc, [(作业名称, 开始时间, 截止时间, 状态, workRelationId, workReEdit), ...])，
+    时间为网页上的字符串（如 "2020-04-10 23:59"），没有时为 None。
+    """
+    # 网页中有如下一段，从里面提取参数 enc。注意，这个 enc 和 getAllWork 的 enc 并不一致。
+    """
+    url = "/work/doHomeWorkNew?courseId=" + courseId + "&classId=" + classId + "&workId=" + workRelationId + "&workAnswerId="
+            + workRelationAnswerId + "&isdisplaytable=2&mooc=1&enc=f7b9e17b6c978b006dea24fcc54cbbe7&workSystem=0&cpi=64590381&standardEnc=";
+        } else if (redit == 1) {
+            url = "/work/doHomeWorkNew?courseId=" + courseId + "&classId=" + classId + "&workId=" + workRelationId + "&workAnswerId="
+                + workRelationAnswerId + "&reEdit=1&isdisplaytable=2&mooc=1&enc=f7b9e17b6c978b006dea24fcc54cbbe7&workSystem=0&cpi=64590381&standardEnc=";
+        }
+    """
+    enc = None
+    temp = text.find("/work/doHomeWorkNew")
+    if temp >= 0:
+        enc_list = re.findall("&enc=(.*?)&", text[temp:temp + 500])
+        if enc_list:
+            enc = enc_list[0]
+
+    html = etree.HTML(text)
+    works = list()
+    for x in html.xpath("//div[@class='ulDiv']/ul/li"):
+        name = str(x.xpath("div[@class='titTxt']/p/a/@title")[0])
+        # t[0] - 开始时间, t[1] - 截止时间
+        t = [i.strip() for i in x.xpath("div[@class='titTxt']/span[@class='pt5']/text()")]
+        status = x.xpath("div[@class='titTxt']/span/strong")[0].text.strip()
+        relation_id = re_edit = None
+        button = x.xpath(".//span[contains(text(), '做作业')]/..")
+        if button:
+            relation_id = button[0].attrib.get("data")
+            re_edit = button[0].attrib.get("data3")
+        works.append((name, t[0] or None, t[1] or None, status, relation_id, re_edit))
+    return enc, works
+
+
+def configure(processes=None, threshold=None):
+    """修改进程池的进程数（0 为不使用进程池）和直接解析的网页长度阈值。
+    """
+    global PROCESSES, INLINE_THRESHOLD, _pool
+    with _lock:
+        if processes is not None:
+            PROCESSES = processes
+        if threshold is not None:
+            INLINE_THRESHOLD = threshold
+        old_pool, _pool = _pool, None
+    if old_pool is not None:
+        old_pool.shutdown()
+
+
+@atexit.register
+def _shutdown():
+    # 在解释器清理模块之前关闭进程池
+    configure(processes=0)
+
+
+def _get_pool():
+    global _pool
+    with _lock:
+        if _pool is None and PROCESSES > 0:
+            # 服务器是多线程的，用 spawn 启动子进程，不继承其他线程持有的锁
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            try:
+                _pool = ProcessPoolExecutor(max_workers=PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+            except TypeError:
+                # python3.6 不支持 mp_context
+                _pool = ProcessPoolExecutor(max_workers=PROCESSES)
+            logger.debug(f"create parse pool, processes={PROCESSES}")
+        return _pool
+
+
+def _timed(func, text, submit_time):
+    """在子进程中执行，返回 (结果, 排队时间, 解析时间)
+    """
+    start = time.time()
+    result = func(text)
+    return result, start - submit_time, time.time() - start
+
+
+def _record(kind, queued, elapsed):
+    with _lock:
+        _stats[kind] += 1
+        _stats["queue_seconds"] += queued
+        _stats["max_queue_seconds"] = max(_stats["max_queue_seconds"], queued)
+        _stats["parse_seconds"] += elapsed
+
+
+def parse(func, text):
+    """用 func(text) 解析网页，func 为本模块的解析函数。
+    """
+    pool = _get_pool() if len(text) >= INLINE_THRESHOLD else None
+    kind = "inline"
+    if pool is not None:
+        from concurrent.futures.process import BrokenProcessPool
+        try:
+            result, queued, elapsed = pool.submit(_timed, func, text, time.time()).result()
+            _record("pool", queued, elapsed)
+            return result
+        except BrokenProcessPool as e:
+            # 子进程被杀死等，重建进程池，本次直接解析
+            logger.error(f"parse pool broken: {e}")
+            configure()
+            kind = "fallback"
+    start = time.perf_counter()
+    result = func(text)
+    _record(kind, 0.0, time.perf_counter() - start)
+    return result
+
+
+def stats():
+    """本进程的解析统计：直接解析、进程池解析、进程池不可用时改为直接解析的次数，
+    在进程池中的排队时间和解析时间（秒）
+    """
+    with _lock:
+        result = dict(_stats)
+    result["processes"] = PROCESSES
+    result["threshold"] = INLINE_THRESHOLD
+    total = result["inline"] + result["pool"] + result["fallback"]
+    result["avg_parse_seconds"] = result["parse_seconds"] / total if total else 0.0
+    result["avg_queue_seconds"] = result["queue_seconds"] / result["pool"] if result["pool"] else 0.0
+    return result
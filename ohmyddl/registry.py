@@ -0,0 +1,160 @@
+"""多个服务器进程共用的会话登记和刷新锁。
+
+session 表记录活跃的会话（sid、学号、最近访问时间、最近截止时间），后台刷新进程据此决定刷新哪些用户；
+refresh_lock 表保证同一用户同时只有一个进程（线程）在刷新，其他请求等待该刷新完成后直接使用其结果。
+"""
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from typing import List
+
+from .cachemanager import commit, connect_db
+
+
+# 同一 sid 两次写入访问时间的最小间隔，单位：秒。截止时间变化时立即写入
+TOUCH_INTERVAL = 30
+# 刷新锁的有效时间，单位：秒。超时后视为持有者已退出，其他进程可以接手
+LOCK_TTL = 120
+# 等待其他进程刷新时的检查间隔，单位：秒
+LOCK_POLL_INTERVAL = 0.2
+
+SessionRow = namedtuple("SessionRow", ["sid", "userName", "lastSeen", "nextDeadline"])
+
+
+class SessionRegistry:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        # 本进程上次写入的 {sid: (写入时间, next_deadline)}
+        self._written = dict()
+
+    def connect(self, **kwargs) -> sqlite3.Connection:
+        conn = connect_db(self.db_path, **kwargs)
+        SessionRegistry.create_table(conn)
+        return conn
+
+    @staticmethod
+    def create_table(conn: sqlite3.Connection):
+        conn.execute("create table if not exists session("
+                     "sid text primary key, user_name text, last_seen real, next_deadline real);")
+        conn.execute("create table if not exists refresh_lock("
+                     "user_name text primary key, owner text, expires real);")
+
+    def touch(self, sid, user_name, next_deadline=None):
+        """记录一次访问。next_deadline 为 None 时保留原来的截止时间。
+        """
+        now = time.time()
+        with self._lock:
+            last = self._written.get(sid)
+            if last is not None and now - last[0] < TOUCH_INTERVAL and next_deadline in (None, last[1]):
+                return
+            if next_deadline is None and last is not None:
+                next_deadline = last[1]
+            self._written[sid] = (now, next_deadline)
+        conn = self.connect()
+        try:
+            conn.execute("insert or replace into session(sid, user_name, last_seen, next_deadline)"
+                         "values(?,?,?,coalesce(?,(select next_deadline from session where sid=?)));",
+                         (sid, user_name, now, next_deadline, sid))
+            commit(conn)
+        finally:
+            conn.close()
+
+    def set_deadline(self, sid, next_deadline):
+        """更新最近截止时间，不改变访问时间（后台刷新不算用户访问）
+        """
+        conn = self.connect()
+        try:
+            conn.execute("update session set next_deadline=? where sid=?;", (next_deadline, sid))
+            commit(conn)
+        finally:
+            conn.close()
+
+    def forget(self, sid):
+        with self._lock:
+            self._written.pop(sid, None)
+        conn = self.connect()
+        try:
+            conn.execute("delete from session where sid=?;", (sid,))
+            commit(conn)
+        finally:
+            conn.close()
+
+    def sessions(self, active_window) -> List[SessionRow]:
+        """active_window 秒内访问过的会话，更早的会话同时删除
+        """
+        since = time.time() - active_window
+        conn = self.connect()
+        try:
+            conn.execute("delete from session where last_seen<?;", (since,))
+            commit(conn)
+            rows = conn.execute("select sid, user_name, last_seen, next_deadline from session;").fetchall()
+        finally:
+            conn.close()
+        return [SessionRow(*x) for x in rows]
+
+    def count(self, active_window) -> int:
+        """active_window 秒内访问过的会话数。只读，不删除过期的会话
+        """
+        conn = self.connect()
+        try:
+            return conn.execute("select count(*) from session where last_seen>=?;",
+                                (time.time() - active_window,)).fetchone()[0]
+        finally:
+            conn.close()
+
+    def _acquire(self, user_name, owner) -> bool:
+        now = time.time()
+        conn = self.connect(isolation_level=None)
+        try:
+            conn.execute("begin immediate;")
+            row = conn.execute("select owner, expires from refresh_lock where user_name=?;",
+                               (user_name,)).fetchone()
+            if row is not None and row[0] != owner and row[1] > now:
+                conn.execute("rollback;")
+                return False
+            conn.execute("insert or replace into refresh_lock(user_name, owner, expires)values(?,?,?);",
+                         (user_name, owner, now + LOCK_TTL))
+            commit(conn)
+            return True
+        finally:
+            conn.close()
+
+    def _release(self, user_name, owner):
+        conn = self.connect()
+        try:
+            conn.execute("delete from refresh_lock where user_name=? and owner=?;", (user_name, owner))
+            commit(conn)
+        finally:
+            conn.close()
+
+    def _locked(self, user_name) -> bool:
+        conn = self.connect()
+        try:
+            return conn.execute("select 1 from refresh_lock where user_name=?;", (user_name,)).fetchone() is not None
+        finally:
+            conn.close()
+
+    @contextlib.contextmanager
+    def refreshing(self, user_name, wait=LOCK_TTL):
+        """获取 user_name 的刷新锁。获取成功时 yield True，由调用者刷新，退出时释放。
+        其他进程（或线程）正在刷新时等待其完成，然后 yield False，调用者直接读取刷新结果；
+        最多等待 wait 秒，超时也 yield False。持有者超过 LOCK_TTL 秒未释放时由本次调用接手。
+        """
+        owner = f"{os.getpid()}-{threading.get_ident()}"
+        deadline = time.monotonic() + wait
+        while not self._acquire(user_name, owner):
+            if time.monotonic() >= deadline:
+                yield False
+                return
+            time.sleep(LOCK_POLL_INTERVAL)
+            if not self._locked(user_name):
+                yield False
+                return
+        try:
+            yield True
+        finally:
+            self._release(user_name, owner)
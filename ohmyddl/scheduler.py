@@ -0,0 +1,238 @@
+"""后台刷新。
+
+在缓存过期之前主动为活跃用户刷新未完成作业，使用户打开页面时总能直接命中缓存。
+最近访问过、最近有作业截止的用户优先刷新；同时刷新的用户数有上限，刷新时间加入随机抖动，避免集中刷新。
+多进程运行时，会话通过 SessionRegistry 共享：各进程只登记访问，由一个进程负责刷新。
+"""
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+from .exceptions import PasswordError, TryTooManyError
+
+logger = logging.getLogger(__name__)
+
+
+class Session:
+    def __init__(self, sid, user_name):
+        self.sid = sid
+        self.user_name = user_name
+        self.last_seen = time.time()
+        # 最近一个未截止作业的截止时间（时间戳），未知时为 None
+        self.next_deadline = None
+        # 随机提前刷新的秒数
+        self.jitter = 0.0
+        # 上次刷新完成的时间（时间戳）。部分课程被略过时结果不写入缓存，用它避免立即再次刷新
+        self.refreshed_at = None
+        # 连续失败次数，以及失败后下次允许刷新的时间（时间戳）
+        self.failures = 0
+        self.retry_at = 0.0
+
+
+class RefreshScheduler:
+    def __init__(self, refresh_func, cached_at_func, ttl, lead=60, jitter=60, max_workers=2,
+                 active_window=3600, interval=5, backoff=60, max_backoff=3600, registry=None):
+        """refresh_func(sid) 刷新用户数据，返回最近一个未截止作业的截止时间（时间戳）或 None。
+
+        cached_at_func(user_name) 返回用户数据的缓存时间（时间戳），没有缓存时返回 None。
+
+        ttl 缓存有效时间，lead 提前多少秒刷新，jitter 额外随机提前的最大秒数，
+        max_workers 同时刷新的最大用户数，active_window 多少秒内访问过的用户视为活跃，interval 检查间隔。
+
+        刷新失败后等待 backoff 秒再重试，每次连续失败等待时间加倍，最多 max_backoff 秒；
+        refresh_func 抛出 PasswordError、TryTooManyError 时不再刷新该会话（forget）。
+
+        registry 为 SessionRegistry 时，touch、forget 写入其中，检查前从中读取所有进程登记的会话。
+        """
+        self.refresh_func = refresh_func
+        self.cached_at_func = cached_at_func
+        self.ttl = ttl
+        self.lead = lead
+        self.jitter = jitter
+        self.max_workers = max_workers
+        self.active_window = active_window
+        self.interval = interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.registry = registry
+        self.sessions: Dict[str, Session] = dict()
+        self.refreshed_count = 0
+        self.failed_count = 0
+        self._running = set()
+        self._waiting = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = None
+
+    def touch(self, sid, user_name, next_deadline=None):
+        """记录一次用户访问
+        """
+        if self.registry is not None:
+            self.registry.touch(sid, user_name, next_deadline)
+            return
+        with self._lock:
+            session = self.sessions.get(sid)
+            if session is None:
+                session = Session(sid, user_name)
+                session.jitter = random.uniform(0, self.jitter)
+                self.sessions[sid] = session
+            session.last_seen = time.time()
+            if next_deadline is not None:
+                session.next_deadline = next_deadline
+
+    def forget(self, sid):
+        if self.registry is not None:
+            self.registry.forget(sid)
+        with self._lock:
+            self.sessions.pop(sid, None)
+
+    def _sync(self):
+        """用 registry 中的会话更新 self.sessions，保留各会话的随机抖动
+        """
+        rows = self.registry.sessions(self.active_window)
+        with self._lock:
+            sids = set()
+            for row in rows:
+                sids.add(row.sid)
+                session = self.sessions.get(row.sid)
+                if session is None:
+                    session = Session(row.sid, row.userName)
+                    session.jitter = random.uniform(0, self.jitter)
+                    self.sessions[row.sid] = session
+                session.last_seen = row.lastSeen
+                if row.nextDeadline is not None:
+                    session.next_deadline = row.nextDeadline
+            for sid in list(self.sessions.keys()):
+                if sid not in sids and sid not in self._running:
+                    del self.sessions[sid]
+
+    @property
+    def queue_depth(self):
+        """等待刷新和正在刷新的用户数
+        """
+        with self._lock:
+            return self._waiting + len(self._running)
+
+    def _priority(self, session, now):
+        # 截止时间越近、访问越近越优先
+        if session.next_deadline is not None and session.next_deadline > now:
+            deadline_distance = session.next_deadline - now
+        else:
+            deadline_distance = float("inf")
+        return deadline_distance, -session.last_seen
+
+    def _due_sessions(self):
+        if self.registry is not None:
+            self._sync()
+        now = time.time()
+        due = list()
+        with self._lock:
+            for sid in list(self.sessions.keys()):
+                session = self.sessions[sid]
+                if now - session.last_seen > self.active_window:
+                    del self.sessions[sid]
+                    continue
+                if sid in self._running or now < session.retry_at:
+                    continue
+                due.append(session)
+        result = list()
+        for session in due:
+            cached_at = self.cached_at_func(session.user_name)
+            if session.refreshed_at is not None and (cached_at is None or cached_at < session.refreshed_at):
+                cached_at = session.refreshed_at
+            if cached_at is None or now >= cached_at + self.ttl - self.lead - session.jitter:
+                result.append(session)
+        result.sort(key=lambda x: self._priority(x, now))
+        return result
+
+    def _refresh(self, session):
+        try:
+            logger.debug(f"background refresh: {session.user_name}")
+            next_deadline = self.refresh_func(session.sid)
+            with self._lock:
+                self.refreshed_count += 1
+                session.next_deadline = next_deadline
+                session.jitter = random.uniform(0, self.jitter)
+                session.refreshed_at = time.time()
+                session.failures = 0
+                session.retry_at = 0.0
+            if self.registry is not None and next_deadline is not None:
+                self.registry.set_deadline(session.sid, next_deadline)
+        except (PasswordError, TryTooManyError) as e:
+            # 重试也不会成功，等用户重新登录
+            logger.error(f"后台刷新失败，不再刷新：{session.user_name}, {e!r}")
+            with self._lock:
+                self.failed_count += 1
+            self.forget(session.sid)
+        except Exception as e:
+            with self._lock:
+                self.failed_count += 1
+                session.failures += 1
+                delay = min(self.max_backoff, self.backoff * 2 ** (session.failures - 1))
+                session.retry_at = time.time() + delay
+            logger.error(f"后台刷新失败：{session.user_name}, {e}，{delay:.0f} 秒后重试")
+        finally:
+            with self._lock:
+                self._running.discard(session.sid)
+
+    def run_once(self):
+        """检查一次需要刷新的用户，并提交不超过空闲线程数的刷新任务。
+        """
+        due = self._due_sessions()
+        with self._lock:
+            free = self.max_workers - len(self._running)
+            submit = due[:max(0, free)]
+            self._waiting = len(due) - len(submit)
+            for session in submit:
+                self._running.add(session.sid)
+        for session in submit:
+            self._executor.submit(self._refresh, session)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"后台刷新出错：{e}")
+
+    def run(self):
+        """在当前线程中运行，直到 stop 被调用
+        """
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            self._loop()
+        finally:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._thread = threading.Thread(target=self._loop, name="refresh-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def status(self):
+        if self.registry is not None:
+            self._sync()
+        with self._lock:
+            return {
+                "sessions": len(self.sessions),
+                "running": len(self._running),
+                "waiting": self._waiting,
+                "refreshed": self.refreshed_count,
+                "failed": self.failed_count
+            }
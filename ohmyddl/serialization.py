@@ -0,0 +1,122 @@
+"""缓存值的序列化。
+
+已注册的类型（学期列表、课程列表、作业列表等）按列保存，开头一个字节为类型标记，
+不依赖类所在的模块路径。字符串列用分隔符连接后整体编码，整数列直接保存 int64 数组，
+解析时只需 split 和 frombytes，比 pickle 逐个重建对象快。未注册的类型仍使用 pickle（以 0x80 开头）。
+
+列的布局：1 字节类型（b"s" 字符串列，b"q" 整数列）、4 字节元素个数、4 字节长度（小端），然后是内容。
+"""
+import functools
+import pickle
+import struct
+import sys
+from array import array
+from typing import Callable, Dict, List, Tuple
+
+
+# 字符串列的分隔符，以及表示 None 的值。网页文本中不会出现这两个控制字符
+SEP = "\x1f"
+NONE = "\x00"
+
+_HEADER = struct.Struct("<cII")
+_codecs: List[Tuple[bytes, Callable, Callable, Callable]] = list()
+_decoders: Dict[bytes, Callable] = dict()
+
+
+def register(tag: bytes, match, encode, decode):
+    """注册一种类型。match(obj) 为 True 的值用 encode(obj) 转为列的列表保存，读取时用 decode(columns) 还原。
+    每一列为 array("q")，或者元素为 str、None 的 list。tag 为一个字节，不能与 pickle 的开头（0x80）相同。
+    """
+    if len(tag) != 1 or tag[0] == 0x80:
+        raise ValueError(f"invalid tag: {tag!r}")
+    if tag in _decoders:
+        raise ValueError(f"tag {tag!r} already registered")
+    _codecs.append((tag, match, encode, decode))
+    _decoders[tag] = decode
+
+
+def dumps(obj) -> bytes:
+    for tag, match, encode, _ in _codecs:
+        if match(obj):
+            try:
+                return tag + pack_columns(encode(obj))
+            except ValueError:
+                # 字符串中含有分隔符等，改用 pickle
+                break
+    return pickle.dumps(obj)
+
+
+def loads(data: bytes):
+    decode = _decoders.get(data[:1])
+    if decode is None:
+        return pickle.loads(data)
+    return decode(unpack_columns(data, 1))
+
+
+def pack_columns(columns) -> bytes:
+    parts = list()
+    for col in columns:
+        if isinstance(col, array):
+            if col.typecode != "q":
+                col = array("q", col)
+            if sys.byteorder == "big":
+                col = array("q", col)
+                col.byteswap()
+            payload = col.tobytes()
+            parts.append(_HEADER.pack(b"q", len(col), len(payload)))
+        else:
+            items = [NONE if x is None else x for x in col]
+            joined = SEP.join(items)
+            if joined.count(SEP) != max(0, len(items) - 1) or joined.count(NONE) != col.count(None):
+                raise ValueError("string contains separator")
+            payload = joined.encode("utf-8")
+            parts.append(_HEADER.pack(b"s", len(items), len(payload)))
+        parts.append(payload)
+    return b"".join(parts)
+
+
+def unpack_columns(data: bytes, offset=0) -> list:
+    columns = list()
+    end = len(data)
+    header_size = _HEADER.size
+    unpack_from = _HEADER.unpack_from
+    while offset < end:
+        kind, count, size = unpack_from(data, offset)
+        offset += header_size
+        payload = data[offset:offset + size]
+        offset += size
+        if kind == b"q":
+            col = array("q")
+            col.frombytes(payload)
+            if sys.byteorder == "big":
+                col.byteswap()
+        elif count == 0:
+            col = []
+        else:
+            text = payload.decode("utf-8")
+            col = text.split(SEP)
+            if NONE in text:
+                col = [None if x == NONE else x for x in col]
+        columns.append(col)
+    return columns
+
+
+def namedtuple_codec(cls):
+    """List[cls] 的 encode、decode，cls 的字段均为 str 或 None。
+    第一列保存字段名，字段顺序或数量变化后按字段名还原：已删除的字段被忽略，新增的字段需有默认值。
+    """
+    fields = list(cls._fields)
+    # 字段名一致时直接用 tuple.__new__ 生成，不经过 cls.__new__ 的参数处理
+    make = functools.partial(tuple.__new__, cls)
+
+    def encode(items):
+        return [fields] + [[x[i] for x in items] for i in range(len(fields))]
+
+    def decode(columns):
+        names, values = columns[0], columns[1:]
+        if names == fields:
+            return list(map(make, zip(*values)))
+        keep = [(k, v) for k, v in zip(names, values) if k in fields]
+        return [cls(**dict(zip([k for k, _ in keep], row))) for row in zip(*[v for _, v in keep])]
+
+    return encode, decode
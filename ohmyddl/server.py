@@ -1,11 +1,21 @@
 import functools
+import json
 import logging
+import os
+import signal
+import socketserver
+import sys
+import time
 from pathlib import Path
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
 
-from .bottle import hook, post, request, response, run, route, static_file
+from .bottle import HTTPResponse, ServerAdapter, get, hook, post, request, response, run, route, static_file
 
-from . import DATA_DIR, exceptions
-from .models import ChaoxingUser
+from . import DATA_DIR, cachemanager, exceptions, journal, metrics, parsers, store, throttle, transport
+from .cachemanager import CacheManager, make_key_str
+from .models import CACHE_DB, ChaoxingUser, work_journal, work_store
+from .registry import SessionRegistry
+from .scheduler import RefreshScheduler
 from .utils import geanerate_sid, check_sid_format
 
 
@@ -14,18 +24,167 @@ _ret_code = {
     1: "invalid token",
     2: "username or password error",
     3: "invalid request message",
+    4: "upstream timeout",
+    5: "upstream unavailable",
+    6: "no cached data",
     -1: "unknown error"
 }
+# SSE 心跳间隔，单位：秒
+EVENT_HEARTBEAT_INTERVAL = 15
+# 多进程模式下，子进程意外退出后重新启动前的等待时间，单位：秒
+RESPAWN_DELAY = 1
+# 多进程模式下各进程写入运行指标的目录
+METRICS_DIR = DATA_DIR / Path("metrics")
 logger = logging.getLogger(__name__)
 web_root = (Path(__file__).parent / Path("webroot")).resolve()
 
 
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    """每个连接一个线程，SSE 长连接不会阻塞其他请求。
+    """
+    daemon_threads = True
+
+
+class RequestHandler(WSGIRequestHandler):
+    def address_string(self):
+        # 不做反向 DNS 查询
+        return self.client_address[0]
+
+
+class PreforkServer(ServerAdapter):
+    """多进程服务器：在父进程中监听端口，然后 fork 出 workers 个子进程共用该 socket 处理请求，
+    每个子进程内仍是每个连接一个线程。父进程不处理请求，只负责重启意外退出的子进程。
+    background 不为 None 时在单独的子进程中运行 background()（后台刷新）。
+
+    父进程不启动任何线程，fork 时不会继承其他线程持有的锁。缓存、会话等状态都在 SQLite 和数据目录中，
+    不在进程间共享内存；上游限流按进程数平分（throttle.divide），运行指标由各进程写入 METRICS_DIR 后汇总
+    （metrics.share）。仅支持有 os.fork 的系统。
+    """
+    def run(self, app):
+        workers = self.options.get("workers", 2)
+        background = self.options.get("background")
+        handler_cls = RequestHandler
+        if self.quiet:
+            class handler_cls(RequestHandler):
+                def log_request(self, *args, **kwargs):
+                    pass
+        srv = make_server(self.host, self.port, app, ThreadingWSGIServer, handler_cls)
+        # {pid: (role, 进程名)}，进程名为 worker 的序号或 background，重启后不变
+        children = dict()
+        # 每个子进程各有一个令牌桶，合计不超过设定的速率
+        throttle.divide(workers + (background is not None))
+        METRICS_DIR.mkdir(exist_ok=True)
+        for file in METRICS_DIR.glob("*.json"):
+            file.unlink()
+
+        def spawn(role, name):
+            pid = os.fork()
+            if pid == 0:
+                # Ctrl+C 由父进程处理，子进程由父进程结束
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                code = 0
+                metrics.share(METRICS_DIR, name)
+                try:
+                    if role == "worker":
+                        srv.serve_forever()
+                    else:
+                        srv.socket.close()
+                        background()
+                except BaseException as e:
+                    logger.error(f"{role} {os.getpid()} 出错：{e}")
+                    code = 1
+                finally:
+                    os._exit(code)
+            children[pid] = (role, name)
+
+        def terminate(signum, frame):
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM, terminate)
+        try:
+            for i in range(workers):
+                spawn("worker", str(i))
+            if background is not None:
+                spawn("background", "background")
+            while True:
+                pid, status = os.wait()
+                child = children.pop(pid, None)
+                if child is None:
+                    continue
+                logger.error(f"{child[0]} {pid} 退出（{status}），{RESPAWN_DELAY} 秒后重新启动")
+                time.sleep(RESPAWN_DELAY)
+                spawn(*child)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            for pid in children:
+                try:
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+            srv.server_close()
+
+
 def setup_logging(level=logging.ERROR):
     root = logging.getLogger()
     root.addHandler(logging.StreamHandler())
     root.setLevel(level)
 
 
+def next_deadline(course_list):
+    """最近一个未截止作业的截止时间（时间戳），没有时返回 None
+    """
+    now = time.time()
+    deadlines = [
+        w.endTimestamp for _, works in course_list for w in works
+        if w.endTimestamp is not None and w.endTimestamp > now
+    ]
+    return min(deadlines) if deadlines else None
+
+
+def background_refresh(sid):
+    """后台刷新 sid 对应用户的未完成作业
+    """
+    file = DATA_DIR / Path(sid)
+    if not file.exists():
+        refresher.forget(sid)
+        return None
+    user = ChaoxingUser.load_from(file)
+    # 其他请求正在刷新该用户时略过
+    with session_registry.refreshing(user.userName, wait=0) as owner:
+        if not owner:
+            return None
+        if not user.is_login:
+            user.login()
+        course_list = user.get_unfinish_work_list(disable_cache=True)
+    user.dump_to()
+    return next_deadline(course_list)
+
+
+def unfinish_work_cached_at(user_name):
+    cm = CacheManager(user_name, CACHE_DB)
+    return cm.get_update_time(make_key_str("get_unfinish_work_list", (), {}))
+
+
+session_registry = SessionRegistry(CACHE_DB)
+refresher = RefreshScheduler(background_refresh, unfinish_work_cached_at, ttl=ChaoxingUser.CACHE_EXPIRE_TIME,
+                             registry=session_registry)
+
+# route 为路由规则（如 /api/login），没有匹配的路由时为空
+http_requests = metrics.Counter("ohmyddl_http_requests_total", "请求次数", ["route", "method", "status"])
+http_latency = metrics.Histogram("ohmyddl_http_request_duration_seconds", "请求处理耗时（SSE 只统计到开始推送）",
+                                 ["route", "method"])
+metrics.Gauge("ohmyddl_active_sessions", "最近访问过的会话数（所有进程）",
+              func=lambda: session_registry.count(refresher.active_window))
+# 多进程运行时后台刷新在单独的进程中（worker="background"），处理请求的进程中总是 0
+metrics.Gauge("ohmyddl_refresh_queue_depth", "等待和正在后台刷新的用户数", func=lambda: refresher.queue_depth)
+
+
 def make_response(ret_code, extra_message=None, body=None):
     message = _ret_code[ret_code]
     if extra_message:
@@ -39,6 +198,16 @@ def make_response(ret_code, extra_message=None, body=None):
     return result
 
 
+def is_offline_request():
+    """请求体中 offline 为 true 时，不检查登录状态、不联网，只使用缓存的数据。
+    """
+    try:
+        payload = request.json
+    except ValueError:
+        return False
+    return isinstance(payload, dict) and bool(payload.get("offline"))
+
+
 def login_required(func):
     """login_required 装饰器，对需要登录的路由使用可在 request 对象中增加属性：user,
     并保证 user 可用。
@@ -54,11 +223,22 @@ def login_required(func):
             if file.exists():
                 request.sid = sid
                 user: ChaoxingUser = ChaoxingUser.load_from(file)
-                if not user.is_login:
+                if is_offline_request():
+                    logger.debug("offline request, skip login check")
+                    is_login = True
+                else:
+                    try:
+                        is_login = user.is_login
+                    except exceptions.CircuitOpenError:
+                        # 上游熔断时无法检查登录状态，直接放行，由缓存提供数据
+                        logger.debug("upstream circuit open, skip login check")
+                        is_login = True
+                if not is_login:
                     logger.debug("login...")
                     try:
                         user.login()
                         request.user = user
+                        refresher.touch(sid, user.userName)
                         return func(*vargs, **kwargs)
                     except exceptions.PasswordError:
                         ret = 2
@@ -67,6 +247,7 @@ def login_required(func):
                         message = str(e)
                 else:
                     request.user = user
+                    refresher.touch(sid, user.userName)
                     return func(*vargs, **kwargs)
             else:
                 logger.debug("token not exists")
@@ -78,6 +259,23 @@ def login_required(func):
     return wrap
 
 
+def session_required(func):
+    """session_required 装饰器：只检查 sid 是否有效，不联网检查登录状态。用于只读取本地数据的路由，
+    在 request 对象中增加属性：sid, user_name。
+    """
+    @functools.wraps(func)
+    def wrap(*vargs, **kwargs):
+        sid = request.get_cookie("sid")
+        if check_sid_format(sid):
+            file = DATA_DIR / Path(sid)
+            if file.exists():
+                request.sid = sid
+                request.user_name = ChaoxingUser.load_from(file).userName
+                return func(*vargs, **kwargs)
+        return make_response(1)
+    return wrap
+
+
 def json_required(func):
     """josn_required 装饰器：如果 content-type 不是 application/json, 直接返回失败。
     如果请求体格式实际不是 json, 也会返回失败。
@@ -97,6 +295,11 @@ def json_required(func):
     return wrap
 
 
+@hook("before_request")
+def before_request():
+    request.environ["ohmyddl.start_time"] = time.perf_counter()
+
+
 @hook("after_request")
 def after_request():
     if hasattr(request, "user"):
@@ -105,6 +308,24 @@ def after_request():
         logger.debug(f"save user object to local drive success.")
 
 
+@hook("after_request")
+def record_request():
+    # 后添加的 after_request 先执行。路由抛出异常时，此时 response 中还不是最终的状态码
+    error = sys.exc_info()[1]
+    if isinstance(error, HTTPResponse):
+        status = error.status_code
+    elif error is not None:
+        status = 500
+    else:
+        status = response.status_code
+    matched = request.environ.get("bottle.route")
+    rule = matched.rule if matched is not None else ""
+    http_requests.inc(rule, request.method, status)
+    start = request.environ.get("ohmyddl.start_time")
+    if start is not None:
+        http_latency.observe(time.perf_counter() - start, rule, request.method)
+
+
 @post("/api/login")
 @json_required
 def login():
@@ -164,37 +385,216 @@ def check_sid():
 @login_required
 @json_required
 def get_unfinish_works():
+    """请求体：{"disable_cache": false, "offline": false}
+
+    缓存未过期时直接查询 work 表，不反序列化缓存。
+    其他进程或后台刷新正在刷新该用户时，等待其完成后直接返回其结果，不重复请求上游。
+    部分课程因超出时间预算被略过时，返回 work 表中已有的数据，dropped 为被略过的课程，
+    update_at 为已获取的课程中最早的更新时间。
+    offline 为 true 时不联网，返回上次的数据（不论是否过期），update_at 为数据的更新时间。
+    """
     disable_cache = False
     if request.json and ("disable_cache" in request.json.keys()): #pylint: disable=no-member
         disable_cache = request.json["disable_cache"] #pylint: disable=unsubscriptable-object
     user = request.user
-    course_list = user.get_unfinish_work_list(disable_cache=disable_cache)
+    offline = is_offline_request()
+    dropped = []
+    if not offline:
+        cached_at = unfinish_work_cached_at(user.userName)
+        expired = cached_at is None or time.time() - cached_at >= ChaoxingUser.CACHE_EXPIRE_TIME
+        if not expired and work_store.update_time(user.userName, -1, complete=False) is None:
+            # 缓存早于 work 表（旧版本写入的缓存），work 表中还没有数据，重新获取一次
+            disable_cache = True
+        if disable_cache or expired:
+            with session_registry.refreshing(user.userName) as owner:
+                if owner:
+                    try:
+                        course_list = user.get_unfinish_work_list(disable_cache=disable_cache)
+                    except exceptions.BudgetExceededError as e:
+                        return make_response(4, str(e))
+                    except exceptions.CircuitOpenError as e:
+                        return make_response(5, str(e))
+                    # 因超出时间预算而略过的课程
+                    dropped = [c.courseName for c in getattr(course_list, "dropped", [])]
+    update_at = work_store.update_time(user.userName, -1, complete=False)
+    if update_at is None:
+        return make_response(6)
+    rows = work_store.unfinished_works(user.userName, -1)
+    now = time.time()
+    upcoming = [x.endTime for x in rows if x.endTime is not None and x.endTime > now]
+    refresher.touch(request.sid, user.userName, upcoming[0] if upcoming else None)
+    # 截止时间未知的排在最前
+    data = [work_row_to_dict(x) for x in rows if x.endTime is None]
+    data.extend(work_row_to_dict(x) for x in rows if x.endTime is not None)
     result = {"ret": 0}
-    data = []
-    for course, works in course_list:
-        for w in works:
-            deadline = w.endTime
-            if deadline is None:
-                deadline = -1
-            else:
-                deadline = deadline.timestamp()
-            data.append({
-                "courseName": course.courseName,
-                "workName": w.workName,
-                "deadline": deadline
-            })
-    data.sort(key=lambda x: x["deadline"])
     result["data"] = data
-    result["update_at"] = user.last_update_time
+    result["dropped"] = dropped
+    result["update_at"] = update_at
+    result["offline"] = offline
+    if offline:
+        result["age"] = int(now - update_at)
     return result
 
 
+def work_row_to_dict(row):
+    return {
+        "courseName": row.courseName,
+        "workName": row.workName,
+        "deadline": row.endTime if row.endTime is not None else -1
+    }
+
+
+@post("/api/get_due_works")
+@session_required
+@json_required
+def get_due_works():
+    """按截止时间查询所有学期的未完成作业，只查询本地的 work 表，不联网。请求体（三选一）：
+
+    {"limit": 5} 最近截止的 5 个；{"within": 86400} 一天内截止的；{"overdue": true} 已过期的。
+    """
+    payload = request.json if isinstance(request.json, dict) else {}
+    now = time.time()
+    try:
+        if payload.get("overdue"):
+            _, rows = work_store.query_works(request.user_name, status=store.OVERDUE, now=now)
+        elif "within" in payload:
+            _, rows = work_store.query_works(request.user_name, due_before=now + float(payload["within"]),
+                                             status=store.PENDING, now=now)
+        else:
+            limit = int(payload.get("limit", 10))
+            if limit <= 0:
+                raise ValueError("limit must be greater than 0")
+            _, rows = work_store.query_works(request.user_name, status=store.PENDING, limit=limit, now=now)
+    except (TypeError, ValueError) as e:
+        return make_response(3, str(e))
+    return {
+        "ret": 0,
+        "message": _ret_code[0],
+        "data": [work_row_to_dict(x) for x in rows]
+    }
+
+
+QUERY_FIELDS = ["courseName", "workName", "deadline", "termId"]
+
+
+@post("/api/query_works")
+@session_required
+@json_required
+def query_works():
+    """查询未完成作业，只查询本地的 work 表，不联网。请求体（均可省略）：
+
+    {"term_id": -1, "course": "课程名称", "due_after": 时间戳, "due_before": 时间戳,
+    "status": "pending|overdue|unknown", "offset": 0, "limit": 20, "fields": ["workName", "deadline"]}
+
+    term_id 省略时查询所有学期；limit 必须大于 0，为 null 时不分页。
+    返回 total（符合条件的总数）、data（当前页，仅包含 fields 中的字段）、next_offset（没有下一页时为 null）。
+    """
+    payload = request.json if isinstance(request.json, dict) else {}
+    fields = payload.get("fields") or QUERY_FIELDS
+    try:
+        if not isinstance(fields, list) or any(x not in QUERY_FIELDS for x in fields):
+            raise ValueError(f"fields must be a subset of {QUERY_FIELDS}")
+        term_id = payload.get("term_id")
+        due_after = payload.get("due_after")
+        due_before = payload.get("due_before")
+        limit = payload.get("limit", 20)
+        if limit is not None:
+            limit = int(limit)
+            if limit <= 0:
+                raise ValueError("limit must be greater than 0")
+        offset = max(0, int(payload.get("offset", 0)))
+        total, rows = work_store.query_works(
+            request.user_name,
+            term_id=None if term_id is None else int(term_id),
+            course=payload.get("course"),
+            due_after=None if due_after is None else float(due_after),
+            due_before=None if due_before is None else float(due_before),
+            status=payload.get("status"),
+            offset=offset,
+            limit=limit,
+            count=True
+        )
+    except (TypeError, ValueError) as e:
+        return make_response(3, str(e))
+    data = list()
+    for row in rows:
+        item = work_row_to_dict(row)
+        item["termId"] = row.termId
+        data.append({k: item[k] for k in fields})
+    next_offset = offset + len(rows)
+    return {
+        "ret": 0,
+        "message": _ret_code[0],
+        "total": total,
+        "data": data,
+        "next_offset": next_offset if next_offset < total else None
+    }
+
+
+@post("/api/get_changes")
+@session_required
+@json_required
+def get_changes():
+    """获取作业变化。请求体：{"since": 时间戳, "since_id": 上次返回的 last_id}，两者都可省略。
+
+    返回的 changes 按 id 升序，kind 为 new/removed/start_time/deadline/status。
+    """
+    payload = request.json if isinstance(request.json, dict) else {}
+    try:
+        since = int(payload.get("since", 0))
+        since_id = int(payload.get("since_id", 0))
+    except (TypeError, ValueError) as e:
+        return make_response(3, str(e))
+    changes = work_journal.changes_since(request.user_name, since_time=since, since_id=since_id)
+    return {
+        "ret": 0,
+        "message": _ret_code[0],
+        "changes": changes,
+        "last_id": changes[-1]["id"] if changes else max(since_id, work_journal.last_id(request.user_name))
+    }
+
+
+@get("/api/events")
+@session_required
+def events():
+    """Server-Sent Events：推送作业变化（事件 change，data 同 /api/get_changes 的 changes 中的一项）。
+
+    断线重连时浏览器会发送 Last-Event-ID，也可以用参数 last_event_id 指定，从该 id 之后继续推送；
+    两者都没有时只推送连接之后的新变化。每 EVENT_HEARTBEAT_INTERVAL 秒发送一次心跳。
+    """
+    sid = request.sid
+    user_name = request.user_name
+    last_id = request.get_header("Last-Event-ID") or request.query.get("last_event_id")
+    try:
+        last_id = int(last_id)
+    except (TypeError, ValueError):
+        last_id = work_journal.last_id(user_name)
+    response.content_type = "text/event-stream; charset=utf-8"
+    response.set_header("Cache-Control", "no-cache")
+    # 连接期间视为活跃用户，由后台刷新产生新的变化
+    refresher.touch(sid, user_name)
+
+    def stream(last_id):
+        yield "retry: 3000\n\n"
+        while True:
+            changes = work_journal.changes_since(user_name, since_id=last_id)
+            for c in changes:
+                last_id = c["id"]
+                yield f"id: {last_id}\nevent: change\ndata: {json.dumps(c, ensure_ascii=False)}\n\n"
+            if not changes:
+                yield ": heartbeat\n\n"
+                refresher.touch(sid, user_name)
+                journal.wait_for_changes(EVENT_HEARTBEAT_INTERVAL)
+    return stream(last_id)
+
+
 @post("/api/logout")
 def logout():
     if hasattr(request, "sid"):
         sid = request.sid
         file = DATA_DIR / Path(sid)
         file.unlink()
+        refresher.forget(sid)
         del request.sid
         del request.user
         logger.debug(f"file {file} deleted.")
@@ -205,6 +605,30 @@ def logout():
     }
 
 
+@route("/api/upstream")
+def upstream_status():
+    """上游限流、熔断、连接池状态，以及缓存压缩、网页解析统计
+    """
+    return {
+        "ret": 0,
+        "message": _ret_code[0],
+        "hosts": throttle.status(),
+        "connections": transport.stats(),
+        "connection_reuse_rate": transport.reuse_rate(),
+        "refresher": refresher.status(),
+        "cache": cachemanager.compression_stats(),
+        "parse": parsers.stats()
+    }
+
+
+@route("/metrics")
+def metrics_text():
+    """Prometheus 文本格式的运行指标。多进程运行时包含所有进程的数据，以标签 worker 区分
+    """
+    response.content_type = "text/plain; version=0.0.4; charset=utf-8"
+    return metrics.render()
+
+
 # static file
 @route("/")
 def home():
@@ -222,9 +646,22 @@ def resource_file2(filepath):
     return static_file(filepath, root=(web_root / Path("static")))
 
 
-def main(host="localhost", port=5986):
+def main(host="localhost", port=5986, workers=None):
+    """workers 为处理请求的进程数，默认为环境变量 OHMYDDL_WORKERS，未设置时为 1（单进程）。
+    环境变量 OHMYDDL_PARSE_PROCESSES 为每个进程用于解析网页的进程池大小，未设置时不使用进程池。
+    """
     setup_logging(level=logging.DEBUG)
-    run(host=host, port=port)
+    if workers is None:
+        workers = int(os.environ.get("OHMYDDL_WORKERS") or 1)
+    parsers.configure(processes=int(os.environ.get("OHMYDDL_PARSE_PROCESSES") or 0))
+    if workers > 1 and hasattr(os, "fork"):
+        run(host=host, port=port, server=PreforkServer, workers=workers, background=refresher.run)
+        return
+    refresher.start()
+    try:
+        run(host=host, port=port, server_class=ThreadingWSGIServer)
+    finally:
+        refresher.stop()
 
 
 if __name__ == "__main__":
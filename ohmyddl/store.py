@@ -0,0 +1,237 @@
+"""课程、作业数据表。
+
+爬取到的学期、课程、作业按列保存（时间为时间戳），并在学号、课程、截止时间上建立索引，
+服务器和命令行可以直接用 SQL 查询，不需要反序列化缓存中的整个列表。
+"""
+import sqlite3
+import time
+from collections import namedtuple
+from typing import List, Optional, Tuple
+
+from .cachemanager import commit, connect_db
+from .utils import duplicate_ordinals
+
+
+CourseRow = namedtuple("CourseRow", ["termId", "pageUrl", "courseName", "teacherName", "courseSeq", "updateTime"])
+WorkRow = namedtuple("WorkRow", ["termId", "courseName", "workName", "startTime", "endTime", "workStatus"])
+
+# 未完成作业的状态
+UNFINISHED = "待做"
+# query_works 的 status 参数：未过期、已过期、截止时间未知
+PENDING = "pending"
+OVERDUE = "overdue"
+UNKNOWN = "unknown"
+
+_SCHEMA = [
+    "create table if not exists term(term_id integer primary key, name text);",
+    "create table if not exists course("
+    "user_name text, term_id integer, page_url text, course_id text, class_id text, "
+    "course_name text, teacher_name text, course_seq text, update_time integer, "
+    "primary key(user_name, page_url));",
+    "create index if not exists course_user_term on course(user_name, term_id);",
+    # 同一课程中可能有同名作业，work_seq 为该作业是第几个同名作业（utils.duplicate_ordinals）
+    "create table if not exists work("
+    "user_name text, page_url text, work_name text, work_seq integer, start_time integer, end_time integer, "
+    "status text, course_id text, class_id text, work_relation_id text, "
+    "work_relation_answer_id text, work_re_edit text, enc text, cpi text, update_time integer, "
+    "primary key(user_name, page_url, work_name, work_seq));",
+    "create index if not exists work_user_course on work(user_name, page_url);",
+    "create index if not exists work_user_deadline on work(user_name, end_time);",
+]
+_WORK_COLUMNS = "c.term_id, c.course_name, w.work_name, w.start_time, w.end_time, w.status"
+
+
+class WorkStore:
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def connect(self) -> sqlite3.Connection:
+        conn = connect_db(self.db_path)
+        WorkStore.create_table(conn)
+        return conn
+
+    @staticmethod
+    def create_table(conn: sqlite3.Connection):
+        # 逐条执行，executescript 会提交当前事务，不能在 WriteBatch 中使用
+        for sql in _SCHEMA:
+            conn.execute(sql)
+
+    def _write(self, op, batch=None):
+        """执行写操作 op(conn)。batch 不为 None 时加入批次，随批次一起提交。
+        """
+        def run(conn):
+            WorkStore.create_table(conn)
+            op(conn)
+        if batch is not None:
+            batch.add(run)
+            return
+        conn = self.connect()
+        try:
+            op(conn)
+            commit(conn)
+        finally:
+            conn.close()
+
+    def save_terms(self, term_id_list, batch=None):
+        def op(conn):
+            conn.executemany("insert or replace into term(term_id, name)values(?,?);", term_id_list)
+        self._write(op, batch)
+
+    def save_courses(self, user_name, term_id, course_list, batch=None):
+        """替换 user_name 在 term_id 学期的课程，已不存在的课程连同其作业一起删除。
+        课程的 update_time 为其作业的更新时间，由 save_works 设置。
+        """
+        page_urls = [c.pageUrl for c in course_list]
+
+        def op(conn):
+            old = conn.execute("select page_url from course where user_name=? and term_id=?;",
+                               (user_name, term_id)).fetchall()
+            removed = [(user_name, x[0]) for x in old if x[0] not in page_urls]
+            conn.executemany("delete from course where user_name=? and page_url=?;", removed)
+            conn.executemany("delete from work where user_name=? and page_url=?;", removed)
+            for c in course_list:
+                cursor = conn.execute(
+                    "update course set term_id=?, course_name=?, teacher_name=?, course_seq=? "
+                    "where user_name=? and page_url=?;",
+                    (term_id, c.courseName, c.teacherName, c.courseSeq, user_name, c.pageUrl))
+                if cursor.rowcount == 0:
+                    conn.execute(
+                        "insert into course(user_name, term_id, page_url, course_name, teacher_name, course_seq)"
+                        "values(?,?,?,?,?,?);",
+                        (user_name, term_id, c.pageUrl, c.courseName, c.teacherName, c.courseSeq))
+        self._write(op, batch)
+
+    def save_works(self, user_name, page_url, works, batch=None):
+        """替换 page_url 对应课程的作业
+        """
+        now = int(time.time())
+        works = list(works)
+        ordinals = duplicate_ordinals([w.workName for w in works])
+
+        def op(conn):
+            conn.execute("delete from work where user_name=? and page_url=?;", (user_name, page_url))
+            conn.executemany(
+                "insert into work(user_name, page_url, work_name, work_seq, start_time, end_time, status, "
+                "course_id, class_id, work_relation_id, work_relation_answer_id, work_re_edit, enc, cpi, "
+                "update_time)values(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?);",
+                [(user_name, page_url, w.workName, seq, w.startTimestamp, w.endTimestamp, w.workStatus,
+                  w.courseId, w.classId, w.workRelationId, w.workRelationAnswerId, w.workReEdit, w.enc, w.cpi, now)
+                 for w, seq in zip(works, ordinals)])
+            if works:
+                conn.execute("update course set course_id=?, class_id=?, update_time=? where user_name=? and page_url=?;",
+                             (works[0].courseId, works[0].classId, now, user_name, page_url))
+            else:
+                conn.execute("update course set update_time=? where user_name=? and page_url=?;",
+                             (now, user_name, page_url))
+        self._write(op, batch)
+
+    def terms(self) -> List[Tuple[int, str]]:
+        conn = self.connect()
+        try:
+            return conn.execute("select term_id, name from term order by term_id desc;").fetchall()
+        finally:
+            conn.close()
+
+    def resolve_term(self, term_id):
+        """-1 表示当前学期（最新的学期）
+        """
+        if term_id != -1:
+            return term_id
+        conn = self.connect()
+        try:
+            row = conn.execute("select max(term_id) from term;").fetchone()
+        finally:
+            conn.close()
+        return row[0]
+
+    def courses(self, user_name, term_id) -> List[CourseRow]:
+        conn = self.connect()
+        try:
+            rows = conn.execute(
+                "select term_id, page_url, course_name, teacher_name, course_seq, update_time from course "
+                "where user_name=? and term_id=? order by rowid;",
+                (user_name, self.resolve_term(term_id))).fetchall()
+        finally:
+            conn.close()
+        return [CourseRow(*x) for x in rows]
+
+    def update_time(self, user_name, term_id, complete=True):
+        """term_id 学期中最早更新的课程的作业更新时间，没有获取过作业的课程不计算在内。
+        没有课程获取过作业时返回 None；complete 为 True 时，只要有课程还没有获取过作业也返回 None。
+        """
+        conn = self.connect()
+        try:
+            row = conn.execute("select min(update_time), count(*) - count(update_time) from course "
+                               "where user_name=? and term_id=?;",
+                               (user_name, self.resolve_term(term_id))).fetchone()
+        finally:
+            conn.close()
+        return None if complete and row[1] > 0 else row[0]
+
+    def unfinished_works(self, user_name, term_id) -> List[WorkRow]:
+        """term_id 学期的未完成作业，按截止时间升序，截止时间未知的排在最后。
+        """
+        conn = self.connect()
+        try:
+            rows = conn.execute(
+                f"select {_WORK_COLUMNS} from work w join course c "
+                "on w.user_name=c.user_name and w.page_url=c.page_url "
+                "where w.user_name=? and c.term_id=? and w.status=? "
+                "order by w.end_time is null, w.end_time, c.rowid, w.rowid;",
+                (user_name, self.resolve_term(term_id), UNFINISHED)).fetchall()
+        finally:
+            conn.close()
+        return [WorkRow(*x) for x in rows]
+
+    def query_works(self, user_name, term_id=None, course=None, due_after=None, due_before=None, status=None,
+                    offset=0, limit=None, now=None, count=False) -> Tuple[Optional[int], List[WorkRow]]:
+        """查询未完成作业，结果按截止时间升序，截止时间未知的排在最后。
+
+        @params term_id 学期（-1 为当前学期，None 为所有学期）；course 课程名称；
+        due_after、due_before 截止时间范围（时间戳，不含边界）；status 为 PENDING、OVERDUE、UNKNOWN 之一或 None。
+
+        @return (符合条件的总数, 当前页的作业)。count 为 False 时不计算总数，返回 (None, 当前页的作业)
+        """
+        now = time.time() if now is None else now
+        conditions = ["w.user_name=?", "w.status=?"]
+        params = [user_name, UNFINISHED]
+        if term_id is not None:
+            conditions.append("c.term_id=?")
+            params.append(self.resolve_term(term_id))
+        if course is not None:
+            conditions.append("c.course_name=?")
+            params.append(course)
+        if due_after is not None:
+            conditions.append("w.end_time>?")
+            params.append(due_after)
+        if due_before is not None:
+            conditions.append("w.end_time<?")
+            params.append(due_before)
+        if status == PENDING:
+            conditions.append("w.end_time>?")
+            params.append(now)
+        elif status == OVERDUE:
+            conditions.append("w.end_time<=?")
+            params.append(now)
+        elif status == UNKNOWN:
+            conditions.append("w.end_time is null")
+        elif status is not None:
+            raise ValueError(f"invalid status: {status}")
+        if status in (PENDING, OVERDUE) or due_after is not None or due_before is not None:
+            # 截止时间已知，按 work_user_deadline 索引的顺序读取，有 limit 时读够即停止
+            order = "w.end_time, w.rowid"
+        else:
+            order = "w.end_time is null, w.end_time, c.rowid, w.rowid"
+        where = " and ".join(conditions)
+        sql_from = "from work w join course c on w.user_name=c.user_name and w.page_url=c.page_url"
+        conn = self.connect()
+        try:
+            total = None
+            if count:
+                total = conn.execute(f"select count(*) {sql_from} where {where};", params).fetchone()[0]
+            rows = conn.execute(
+                f"select {_WORK_COLUMNS} {sql_from} where {where} order by {order} limit ? offset ?;",
+                params + [-1 if limit is None else limit, offset]).fetchall()
+        finally:
+            conn.close()
+        return total, [WorkRow(*x) for x in rows]
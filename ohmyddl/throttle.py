@@ -0,0 +1,183 @@
+"""上游请求限流与熔断。
+
+每个站点（host）一个令牌桶和一个熔断器，进程内所有用户共用，避免同时刷新大量用户时被上游限制。
+令牌桶和熔断器不在进程间共享：多进程运行时用 divide(进程数) 平分速率和桶容量，各进程合计不超过 RATE、BURST；
+熔断器仍各自计数，上游故障时每个进程分别熔断，恢复时每个进程各放行一个试探请求。
+"""
+import threading
+import time
+from typing import Dict
+
+
+# 令牌桶：每秒补充的令牌数、桶容量
+RATE = 5.0
+BURST = 10
+# 熔断器：连续失败多少次后熔断、熔断多少秒后尝试恢复
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, timeout=None) -> bool:
+        """取一个令牌，令牌不足时等待。timeout 秒内取不到返回 False，timeout 为 None 时一直等待。
+        """
+        start = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.waited += now - start
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if timeout is not None and (now - start + wait) > timeout:
+                return False
+            time.sleep(wait)
+
+    def state(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "tokens": round(self.tokens, 2),
+                "waited": round(self.waited, 3)
+            }
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.status = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """是否允许发出请求。熔断 reset_timeout 秒后放行一个试探请求。
+        """
+        with self._lock:
+            if self.status == self.CLOSED:
+                return True
+            if self.status == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.status = self.HALF_OPEN
+                self._trial_running = False
+            # HALF_OPEN: 同一时间只放行一个请求
+            if self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def release(self):
+        """allow 放行的请求没有发出或没有结果时调用，交还半开状态的试探机会，不改变熔断状态
+        """
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self.status = self.CLOSED
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.status == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.status != self.OPEN:
+                    self.trips += 1
+                self.status = self.OPEN
+                self.opened_at = time.monotonic()
+                self._trial_running = False
+
+    def state(self):
+        with self._lock:
+            result = {
+                "status": self.status,
+                "failures": self.failures,
+                "trips": self.trips,
+                "failure_threshold": self.failure_threshold,
+                "reset_timeout": self.reset_timeout
+            }
+            if self.status == self.OPEN:
+                result["retry_after"] = round(
+                    max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at)), 1)
+            return result
+
+
+_lock = threading.Lock()
+_limiters: Dict[str, TokenBucket] = dict()
+_breakers: Dict[str, CircuitBreaker] = dict()
+
+
+def get_limiter(host) -> TokenBucket:
+    with _lock:
+        if host not in _limiters:
+            _limiters[host] = TokenBucket(RATE, BURST)
+        return _limiters[host]
+
+
+def get_breaker(host) -> CircuitBreaker:
+    with _lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(FAILURE_THRESHOLD, RESET_TIMEOUT)
+        return _breakers[host]
+
+
+def configure(rate=None, burst=None, failure_threshold=None, reset_timeout=None):
+    """修改限流与熔断参数，对已创建的令牌桶和熔断器同样生效。
+    """
+    global RATE, BURST, FAILURE_THRESHOLD, RESET_TIMEOUT
+    with _lock:
+        RATE = RATE if rate is None else rate
+        BURST = BURST if burst is None else burst
+        FAILURE_THRESHOLD = FAILURE_THRESHOLD if failure_threshold is None else failure_threshold
+        RESET_TIMEOUT = RESET_TIMEOUT if reset_timeout is None else reset_timeout
+        for limiter in _limiters.values():
+            limiter.rate, limiter.burst = RATE, BURST
+        for breaker in _breakers.values():
+            breaker.failure_threshold, breaker.reset_timeout = FAILURE_THRESHOLD, RESET_TIMEOUT
+
+
+def divide(processes):
+    """把当前的速率和桶容量平分给 processes 个进程，在创建子进程之前调用
+    """
+    configure(rate=RATE / processes, burst=max(1, BURST // processes))
+
+
+def status():
+    """各站点的限流与熔断状态
+
+    返回 {"oauth.shu.edu.cn": {"limiter": {...}, "breaker": {...}}, ...}
+    """
+    with _lock:
+        hosts = set(_limiters.keys()) | set(_breakers.keys())
+    result = dict()
+    for host in sorted(hosts):
+        result[host] = {
+            "limiter": get_limiter(host).state(),
+            "breaker": get_breaker(host).state()
+        }
+    return result
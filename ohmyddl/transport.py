@@ -0,0 +1,103 @@
+"""HTTP 连接池。
+
+所有 ChaoxingUser 的 Session 共用同一组 HTTPAdapter，因此从文件加载的用户对象、
+以及多个用户之间都能复用已经建立的 TCP/TLS 连接。cookie 保存在 Session 上，共用连接池不会混淆用户。
+压缩传输使用 requests 的默认设置（安装了 brotli、zstandard 时也会请求 br、zstd）。
+"""
+import logging
+import threading
+from typing import Dict
+
+
+# 并发获取课程作业的线程数
+FETCH_CONCURRENCY = 4
+# 每个站点保留的连接数。连接池由进程内所有线程共用：后台刷新（2 个用户）、历史模式（2 个学期）
+# 各自以 FETCH_CONCURRENCY 个线程请求，再加上处理请求的线程。超出的连接用完即关闭，下次需要重新握手
+POOL_MAXSIZE = 32
+# 会访问到的站点，决定 PoolManager 最多保留多少个连接池
+UPSTREAM_HOSTS = [
+    "www.elearning.shu.edu.cn",
+    "i.mooc.elearning.shu.edu.cn",
+    "mooc1.elearning.shu.edu.cn",
+    "oauth.shu.edu.cn",
+    "shu.fysso.chaoxing.com",
+]
+
+logger = logging.getLogger(__name__)
+_lock = threading.Lock()
+_adapter = None
+
+
+def configure(concurrency=None, hosts=None, pool_maxsize=None):
+    """修改连接池参数，已挂载旧连接池的 Session 需重新调用 mount。
+    """
+    global FETCH_CONCURRENCY, UPSTREAM_HOSTS, POOL_MAXSIZE, _adapter
+    with _lock:
+        if concurrency is not None:
+            FETCH_CONCURRENCY = concurrency
+        if pool_maxsize is not None:
+            POOL_MAXSIZE = pool_maxsize
+        if hosts is not None:
+            UPSTREAM_HOSTS = list(hosts)
+        old_adapter, _adapter = _adapter, None
+    if old_adapter is not None:
+        old_adapter.close()
+
+
+def get_adapter() -> "HTTPAdapter":
+    global _adapter
+    with _lock:
+        if _adapter is None:
+            from requests.adapters import HTTPAdapter
+            _adapter = HTTPAdapter(
+                pool_connections=len(UPSTREAM_HOSTS),
+                pool_maxsize=POOL_MAXSIZE
+            )
+            logger.debug(f"create HTTPAdapter, pool_connections={len(UPSTREAM_HOSTS)}, "
+                         f"pool_maxsize={POOL_MAXSIZE}")
+        return _adapter
+
+
+def mount(session):
+    """让 session 使用共享的连接池。
+    """
+    from requests.utils import default_headers
+    adapter = get_adapter()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # 旧版本保存的 Session 中固定为 "gzip, deflate"，恢复为 requests 的默认值
+    session.headers["Accept-Encoding"] = default_headers()["Accept-Encoding"]
+
+
+def stats() -> Dict[str, Dict[str, int]]:
+    """各站点的连接统计。
+
+    返回 {"http://www.elearning.shu.edu.cn": {"requests": 10, "connections": 2}, ...}
+    """
+    result = dict()
+    with _lock:
+        adapter = _adapter
+    if adapter is None:
+        return result
+    pools = adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        name = f"{pool.scheme}://{pool.host}"
+        item = result.setdefault(name, {"requests": 0, "connections": 0})
+        item["requests"] += pool.num_requests
+        item["connections"] += pool.num_connections
+    return result
+
+
+def reuse_rate() -> float:
+    """连接复用率：不需要新建连接的请求所占比例。
+    """
+    requests_count = connections_count = 0
+    for item in stats().values():
+        requests_count += item["requests"]
+        connections_count += item["connections"]
+    if requests_count == 0:
+        return 0.0
+    return max(0.0, 1 - connections_count / requests_count)
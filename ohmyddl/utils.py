@@ -1,19 +1,44 @@
+import contextlib
+import importlib
+import os
 import random
+import re
 import string
 import sys
+import tempfile
 import threading
+import time
+from datetime import datetime, timedelta, timezone
 from io import StringIO
 from pathlib import Path
 from typing import List, Dict
 import urllib.parse as urlparse
 
-import requests
-
 from . import DATA_DIR
 
 # ---------------------------------------------
 
 
+class LazyModule:
+    """第一次访问属性时才导入模块，用于推迟 lxml、requests 等耗时的导入。
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+def lazy_import(name) -> LazyModule:
+    return LazyModule(name)
+
+
+# ---------------------------------------------
+
+
 alias_table = {
     "毛泽东思想和中国特色社会主义理论体系概论*": "毛概",
     "马克思主义基本原理概论*": "马原",
@@ -145,7 +170,7 @@ def table(data: List[List[str]], header: List[str]):
 def fetch_term_desc(term_id_list, term_id):
     if term_id == -1:
         return term_id_list[0][1]
-    elif term_id:
+    elif term_id == 0:
         return "不限"
     for term in term_id_list:
         if term[0] == term_id:
@@ -153,6 +178,61 @@ def fetch_term_desc(term_id_list, term_id):
     return "未知"
 
 
+# 学习通页面上的时间均为北京时间。固定 UTC+8，不依赖 tzdata
+SHANGHAI_TZ = timezone(timedelta(hours=8), "Asia/Shanghai")
+WORK_TIME_FORMAT = "%Y-%m-%d %H:%M"
+_WORK_TIME_RE = re.compile(r"(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d)\Z", re.ASCII)
+
+
+def parse_work_time(s, tz=SHANGHAI_TZ) -> datetime:
+    """解析 "2020-04-10 23:59" 格式的时间，返回带时区 tz 的 datetime。
+    只接受这一种固定格式，比 datetime.strptime 快得多。格式或数值不正确时抛出 ValueError。
+    """
+    m = _WORK_TIME_RE.match(s)
+    if m is None:
+        raise ValueError(f"time data {s!r} does not match format {WORK_TIME_FORMAT!r}")
+    year, month, day, hour, minute = m.groups()
+    return datetime(int(year), int(month), int(day), int(hour), int(minute), tzinfo=tz)
+
+
+def to_timestamp(dt):
+    """datetime 转为整数时间戳（秒），没有时区的 datetime 按北京时间处理。dt 为 None 时返回 None。
+    """
+    if dt is None:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=SHANGHAI_TZ)
+    return int(dt.timestamp())
+
+
+def duplicate_ordinals(names) -> List[int]:
+    """names 中每一项是第几个同名的项（从 0 开始）。同一课程中可能有多个同名作业，
+    (作业名称, 序号) 可以区分它们，并且不受其他作业增删的影响。
+
+    duplicate_ordinals(["作业", "测验", "作业"]) 返回 [0, 0, 1]
+    """
+    seen = dict()
+    result = list()
+    for name in names:
+        n = seen.get(name, 0)
+        seen[name] = n + 1
+        result.append(n)
+    return result
+
+
+def format_age(seconds):
+    """把经过的秒数转为“3分钟前”的形式
+    """
+    seconds = max(0, int(seconds))
+    if seconds < 60:
+        return "刚刚"
+    elif seconds < 3600:
+        return f"{seconds // 60}分钟前"
+    elif seconds < 86400:
+        return f"{seconds // 3600}小时前"
+    return f"{seconds // 86400}天前"
+
+
 def get_params_from_url(url) -> Dict[str, str]:
     """从 url 中获取参数，如有重复键只保留首个。
 
@@ -184,6 +264,57 @@ def check_sid_format(sid):
 
 # -----------------------------------------------
 
+@contextlib.contextmanager
+def file_lock(path):
+    """进程间互斥地修改 path（advisory lock，只对同样加锁的进程有效）。
+    锁文件保存在 path 所在目录的 .locks 子目录中，不会与 path 混在一起。
+    """
+    path = Path(path)
+    lock_dir = path.parent / ".locks"
+    lock_dir.mkdir(parents=True, exist_ok=True)
+    with open(str(lock_dir / (path.name + ".lock")), "a+b") as f:
+        if sys.platform == "win32":
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    # LK_LOCK 重试 10 秒后仍失败时抛出 OSError，继续等待
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def write_file_atomic(path, data: bytes):
+    """加锁后先写入临时文件再替换 path，其他进程读取时只会看到完整的旧文件或新文件。
+    """
+    path = Path(path)
+    with file_lock(path):
+        fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix=f".{path.name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, str(path))
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp)
+            raise
+
+
 def get_user_id():
     file = DATA_DIR / Path("userid")
     if file.exists() and file.is_file():
@@ -203,8 +334,17 @@ def get_user_id():
     return None
 
 
+AVAILABLE_CHECK_URL = "http://api.qiren.org/ohmyddl/can_i_use"
+# 检查请求的超时时间、检查结果的有效时间，单位：秒
+AVAILABLE_CHECK_TIMEOUT = 3
+AVAILABLE_CHECK_TTL = 86400
+
+
 def check_available(blocking=False):
     """判断本程序是否可用。只有得到服务器明确回应后才关闭。
+
+    检查结果（可用）会缓存 AVAILABLE_CHECK_TTL 秒。设置环境变量 OHMYDDL_NO_CHECK=1 可跳过检查。
+    非阻塞模式下在守护线程中检查，不会阻止程序退出。
     """
     def print_message():
         print("=============================")
@@ -216,20 +356,32 @@ def check_available(blocking=False):
         print_message()
         sys.exit(0)
 
+    if os.environ.get("OHMYDDL_NO_CHECK"):
+        return
+
+    checked_file = DATA_DIR / Path("available")
+    try:
+        if time.time() - checked_file.stat().st_mtime < AVAILABLE_CHECK_TTL:
+            return
+    except OSError:
+        pass
+
     if not blocking:
-        t = threading.Thread(target=check_available, args=(True, ))
+        t = threading.Thread(target=check_available, args=(True, ), daemon=True)
         t.start()
         return
-    url = "http://api.qiren.org/ohmyddl/can_i_use"
     # wumingshi - 无名氏
     uid = get_user_id() or "wumingshi"
     params = { "uid":  uid}
     try:
-        r = requests.get(url, params=params)
+        import requests
+        r = requests.get(AVAILABLE_CHECK_URL, params=params, timeout=AVAILABLE_CHECK_TIMEOUT)
         if r.status_code == 200 and r.text == "no":
             with file.open("a"):
                 pass
             print_message()
             sys.exit(0)
+        if r.status_code == 200:
+            checked_file.touch()
     except:
         pass